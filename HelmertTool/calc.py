@@ -1,56 +1,450 @@
 import pandas as pd
 import numpy as np 
+import math
+import hashlib
+import threading
+from collections import OrderedDict
 
-from HelmertTool.io import calculate_long_lat
+from HelmertTool.io import calculate_long_lat, ecef_to_geodetic, propagate_epoch
 from HelmertTool.interface.InterfaceState import InterfaceState
 
-def calculate_parameters(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict : dict = None):
-    """Calculates Helmert parameters with the option of one, two, or three scale variables and a dict specifying values of parameters of which it should not calculate"""
+parameter_names = InterfaceState.ParameterState.parameter_names
+
+def calculate_parameters(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict : dict = None, solver: str = "cholesky", full_output: bool = False, epoch: float = None, robust: str = None, max_iterations: int = 50, tolerance: float = 1e-6):
+    """Calculates Helmert parameters with the option of one, two, or three scale variables and a dict specifying values of parameters of which it should not calculate.
+
+    Weighted fits use the per station X/Y/Z covariances if either frame has XY_cov, XZ_cov and YZ_cov columns (as 
+    from io.load_snx). solver selects the least squares backend, see least_squares. With full_output a third dict is returned holding the 
+    condition number of the column scaled design matrix, large values indicate a degenerate fit. If epoch is given both 
+    frames are propagated to it with their velocities before fitting, see io.propagate_epoch. Values of custom_dict 
+    fix a parameter, (value, sigma) tuples softly constrain it (sigma relative to unit weight for unweighted fits).
+
+    robust ("huber" or "tukey") selects an M-estimator fit by iteratively reweighted least squares, see 
+    robust_least_squares, then info also holds the final per station weights (a series indexed as df_from), the 
+    number of iterations and whether the fit converged."""
+
+    if epoch is not None:
+        df_from = propagate_epoch(df_from, epoch, columns = [])
+        df_to = propagate_epoch(df_to, epoch, columns = [])
 
     if not custom_dict:
-        custom_dict = {name : None for name in InterfaceState.ParameterState.parameter_names}
+        custom_dict = {name : None for name in parameter_names}
 
-    design_vectors = get_design_columns(df_from)
+    design_matrix = np.vstack(list(get_design_columns(df_from).values())).T
     observation_vector = get_observation_vector(df_from, df_to)
 
-    #Subtract custom variables and delete those columns
-    keys_to_delete = []
-    for parameter, custom_value in custom_dict.items():
-        if not custom_value is None:
-            observation_vector = observation_vector - design_vectors[parameter] * custom_value
-            keys_to_delete.append(parameter)
-    for key in keys_to_delete:
-        del design_vectors[key]
-
-    #Merge columns and create final design matrix
-    if type == "7" and "scale_x" in design_vectors:
-        #Scale_x is really scale_xyz here
-        design_vectors["scale_x"] = design_vectors["scale_x"] + design_vectors["scale_y"] + design_vectors["scale_z"]
-        del design_vectors["scale_y"]        
-        del design_vectors["scale_z"]        
-    
-    if type == "8" and "scale_x" in design_vectors:
-        #Scale_x is really scale_xy here
-        design_vectors["scale_x"] = design_vectors["scale_x"] + design_vectors["scale_y"]
-        del design_vectors["scale_y"]              
-
-    design_matrix = np.vstack(list(design_vectors.values())).T
+    #Subtract custom variables and merge the scale columns into the final design matrix
+    names, combination, fixed_values = get_parameter_map(type, custom_dict)
+    observation_vector = observation_vector - design_matrix @ fixed_values
+    design_matrix = design_matrix @ combination
 
     #Perform least square regression and return values in a dict
     uncertainties = {parameter : np.nan for parameter in custom_dict}
+    observation_var = None
+    if weighted and (has_covariance(df_from) or has_covariance(df_to)):
+        observation_var = get_covariance_blocks(df_from, df_to)
+    elif weighted:
+        observation_var = get_var_vector(df_from, df_to)
+    constraints = get_constraint_rows(names, custom_dict)
+    if robust is None:
+        parameters, covariance, condition_number = least_squares(design_matrix, observation_vector, observation_var, solver, constraints)
+    else:
+        parameters, covariance, condition_number, robust_info = robust_least_squares(design_matrix, observation_vector, observation_var, robust, solver, max_iterations, tolerance, constraints)
+        robust_info["station_weights"] = pd.Series(robust_info["station_weights"], index = df_from.index, name = "Weight")
+
     if weighted:
-        observation_var_matrix = get_var_matrix(df_from, df_to)
-        parameters, new_uncertainties = weighted_least_squares(design_matrix, observation_vector, observation_var_matrix)
-        new_uncertainties = {parameter : sigma for parameter, sigma in zip(design_vectors, new_uncertainties)}
+        new_uncertainties = {parameter : sigma for parameter, sigma in zip(names, np.sqrt(np.diag(covariance)))}
         uncertainties.update(new_uncertainties)
-   
+
+    parameters = {parameter : value for parameter, value in zip(names, parameters)}
+
+    if full_output:
+        info = {"solver" : solver, "condition_number" : condition_number}
+        if robust is not None:
+            info.update(robust_info)
+        return parameters, uncertainties, info
+
+    return parameters, uncertainties
+
+def calculate_parameters_batch(xyz_from, xyz_to, var = None, mask = None, type: str = "7", custom_dict: dict = None):
+    """Calculates Helmert parameters for a stack of frame pairs, e.g. daily solutions against a reference frame, in one vectorized pass.
+
+    xyz_to is an (epochs, n, 3) array of coordinates, xyz_from either a matching stack or a single (n, 3) reference frame. 
+    var holds the (epochs, n, 3) observation variances of a weighted fit (None for an unweighted one) and mask an 
+    (epochs, n) boolean array marking the stations present in each epoch. Returns dicts of (epochs,) arrays of parameters 
+    and uncertainties as calculate_parameters, epochs with less than three stations give nan."""
+    xyz_from = np.asarray(xyz_from, dtype=np.float64)
+    xyz_to = np.asarray(xyz_to, dtype=np.float64)
+    shape = np.broadcast_shapes(xyz_from.shape, xyz_to.shape)
+    mask = np.ones(shape[:-1], dtype=bool) if mask is None else np.broadcast_to(mask, shape[:-1])
+
+    weights = np.ones(shape) if var is None else 1/np.asarray(var, dtype=np.float64)
+    weights = np.where(mask[..., np.newaxis], weights, 0)
+    observations = np.where(mask[..., np.newaxis], xyz_to - xyz_from, 0)
+    blocks = get_design_blocks(np.where(mask[..., np.newaxis], xyz_from, 0))
+
+    normal_matrix = np.einsum("...nki,...nk,...nkj->...ij", blocks, weights, blocks, optimize=True)
+    normal_vector = np.einsum("...nki,...nk,...nk->...i", blocks, weights, observations, optimize=True)
+
+    names, combination, fixed_values = get_parameter_map(type, custom_dict)
+    normal_vector = (normal_vector - normal_matrix @ fixed_values) @ combination
+    normal_matrix = combination.T @ normal_matrix @ combination
+    normal_matrix, normal_vector, _, _ = add_soft_constraints(names, normal_matrix, normal_vector, 0, custom_dict)
+
+    #Replace underdetermined epochs by a solvable dummy system and mask them out afterwards
+    valid = mask.sum(axis=-1) >= 3
+    normal_matrix = np.where(valid[..., np.newaxis, np.newaxis], normal_matrix, np.eye(len(names)))
+    parameters, covariance, _ = solve_normal_equations(normal_matrix, normal_vector)
+    parameters = np.where(valid[..., np.newaxis], parameters, np.nan)
+
+    uncertainties = {parameter : np.full(valid.shape, np.nan) for parameter in parameter_names}
+    if var is not None:
+        sigmas = np.where(valid[..., np.newaxis], np.sqrt(np.diagonal(covariance, axis1=-2, axis2=-1)), np.nan)
+        uncertainties.update({parameter : sigmas[..., j] for j, parameter in enumerate(names)})
+    parameters = {parameter : parameters[..., j] for j, parameter in enumerate(names)}
+
+    return parameters, uncertainties
+
+def calculate_kinematic_parameters(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, epoch: float = None, full_output: bool = False):
+    """Calculates Helmert parameters and their rates (14 parameters for the 7 parameter type) in a single joint solve of 
+    the position and velocity differences of two frames with X_v, Y_v and Z_v columns.
+
+    The positions are compared at epoch, both frames are propagated to it (the first reference epoch of df_from if 
+    None, frames without an Epoch column are compared as they are) and the parameters refer to that epoch, see 
+    parameters_at_epoch. Rates are named as the parameters with a 
+    _rate suffix and may be fixed in custom_dict like the parameters. With full_output a third dict holds the 
+    condition number, chi squared, degrees of freedom and the reference epoch."""
+    if not custom_dict:
+        custom_dict = {}
+    if epoch is None and "Epoch" in df_from and "Epoch" in df_to:
+        epoch = float(df_from["Epoch"].iloc[0])
+
+    positions = NormalEquations(weighted).add_frames(df_from, df_to, epoch)
+    velocities = NormalEquations(weighted).add_frames(df_from, df_to, velocity = True)
+
+    names, combination, fixed_values = get_parameter_map(type, custom_dict)
+    rate_names, rate_combination, rate_fixed_values = get_parameter_map(type, {name : custom_dict.get(name + "_rate") for name in parameter_names})
+    rate_names = [name + "_rate" for name in rate_names]
+
+    #Joint block diagonal system of the parameters and their rates
+    n_parameters = len(parameter_names)
+    normal_matrix = np.zeros((2*n_parameters, 2*n_parameters))
+    normal_matrix[:n_parameters, :n_parameters] = positions.normal_matrix
+    normal_matrix[n_parameters:, n_parameters:] = velocities.normal_matrix
+    normal_vector = np.hstack((positions.normal_vector, velocities.normal_vector))
+    joint_combination = np.zeros((2*n_parameters, len(names) + len(rate_names)))
+    joint_combination[:n_parameters, :len(names)] = combination
+    joint_combination[n_parameters:, len(names):] = rate_combination
+    joint_fixed_values = np.hstack((fixed_values, rate_fixed_values))
+
+    square_sum = positions.observation_square_sum + velocities.observation_square_sum
+    square_sum = square_sum - 2 * joint_fixed_values @ normal_vector + joint_fixed_values @ normal_matrix @ joint_fixed_values
+    normal_vector = joint_combination.T @ (normal_vector - normal_matrix @ joint_fixed_values)
+    normal_matrix = joint_combination.T @ normal_matrix @ joint_combination
+    normal_matrix, normal_vector, square_sum, n_constraints = add_soft_constraints(names + rate_names, normal_matrix, normal_vector, square_sum, custom_dict)
+    parameters, covariance, condition_number = solve_normal_equations(normal_matrix, normal_vector)
+
+    uncertainties = {parameter : np.nan for parameter in [*parameter_names, *[name + "_rate" for name in parameter_names]]}
+    if weighted:
+        uncertainties.update({parameter : sigma for parameter, sigma in zip(names + rate_names, np.sqrt(np.diag(covariance)))})
+    chi_squared = square_sum - parameters @ normal_vector
+    parameters = {parameter : value for parameter, value in zip(names + rate_names, parameters)}
+
+    if full_output:
+        info = {"solver" : "cholesky",
+                "condition_number" : condition_number,
+                "chi_squared" : chi_squared,
+                "degrees_of_freedom" : positions.n_observations + velocities.n_observations + n_constraints - len(parameters),
+                "epoch" : epoch if epoch is not None else np.nan}
+        return parameters, uncertainties, info
+
+    return parameters, uncertainties
+
+def parameters_at_epoch(parameters: dict, epoch: float, reference_epoch: float):
+    """Returns the static parameters of a kinematic transform at epoch, from parameters and rates at reference_epoch"""
+    return {name : value + (epoch - reference_epoch) * parameters.get(name + "_rate", 0) 
+            for name, value in parameters.items() if not name.endswith("_rate")}
+
+def calculate_parameters_rejecting_outliers(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, threshold: float = 3.0, max_iterations: int = 10, epoch: float = None):
+    """Calculates Helmert parameters while iteratively rejecting outlier stations.
+
+    Each iteration the station with the largest normalized residual sqrt(v'Pv / (3 s0^2)), with s0^2 the a posteriori 
+    variance of unit weight, is rejected if it exceeds threshold. Rejected stations are removed by subtracting their 
+    contribution from the normal equations rather than by refitting. Returns the parameters, uncertainties, the index 
+    labels of the rejected stations and a list with a dict per iteration holding the rejected station, its normalized 
+    residual, the chi squared, degrees of freedom and parameters of that iteration."""
+    if epoch is not None:
+        df_from = propagate_epoch(df_from, epoch, columns = [])
+        df_to = propagate_epoch(df_to, epoch, columns = [])
+
+    xyz, observations, var = get_frame_observations(df_from, df_to, weighted)
+    blocks = get_design_blocks(xyz)
+    weights = get_station_weights(var, len(xyz), weighted)
+    station_normal_matrix, station_normal_vector, station_square_sum = get_station_normals(blocks, weights, observations)
+
+    normal_equations = NormalEquations(weighted)
+    normal_equations.normal_matrix = station_normal_matrix.sum(axis=0)
+    normal_equations.normal_vector = station_normal_vector.sum(axis=0)
+    normal_equations.observation_square_sum = station_square_sum.sum()
+    normal_equations.n_observations = observations.size
+
+    _, combination, fixed_values = get_parameter_map(type, custom_dict)
+    active = np.ones(len(xyz), dtype=bool)
+    rejected = []
+    history = []
+
+    for iteration in range(max_iterations + 1):
+        parameters, uncertainties, info = normal_equations.solve(type, custom_dict, full_output = True)
+
+        #Normalized residuals of the remaining stations
+        full_parameters = combination @ np.array(list(parameters.values())) + fixed_values
+        residuals = observations - blocks @ full_parameters
+        unit_variance = info["chi_squared"] / info["degrees_of_freedom"]
+        statistic = np.sqrt(np.einsum("nk,nkl,nl->n", residuals, weights, residuals) / (3 * unit_variance))
+        statistic[~active] = np.nan
+
+        station = np.nanargmax(statistic)
+        history.append({"iteration" : iteration, 
+                        "station" : None,
+                        "normalized_residual" : statistic[station],
+                        "chi_squared" : info["chi_squared"],
+                        "degrees_of_freedom" : info["degrees_of_freedom"],
+                        "parameters" : parameters})
+        if statistic[station] <= threshold or iteration == max_iterations or info["degrees_of_freedom"] <= 3:
+            break
+
+        #Downdate the normal equations by the rejected station
+        active[station] = False
+        rejected.append(df_from.index[station])
+        history[-1]["station"] = df_from.index[station]
+        normal_equations.normal_matrix = normal_equations.normal_matrix - station_normal_matrix[station]
+        normal_equations.normal_vector = normal_equations.normal_vector - station_normal_vector[station]
+        normal_equations.observation_square_sum -= station_square_sum[station]
+        normal_equations.n_observations -= 3
+
+    return parameters, uncertainties, rejected, history
+
+def calculate_leave_one_out(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, epoch: float = None):
+    """Calculates the Helmert parameters with each station left out in turn from a single factorization of the full fit.
+
+    With Q the inverse normal matrix, the fit without station i follows from the update identity 
+    x_i = x - Q A_i' (C_i - A_i Q A_i')^-1 v_i, with A_i, C_i and v_i the design, observation covariance and residuals 
+    of the station, so all n fits cost O(n) work. Returns a dataframe of the station deleted parameters indexed as 
+    df_from, the jackknife uncertainties of the parameters and the influence (Cook's distance) of each station. 
+    Stations whose deletion leaves the fit underdetermined get nan, as do the jackknife uncertainties then."""
+    if epoch is not None:
+        df_from = propagate_epoch(df_from, epoch, columns = [])
+        df_to = propagate_epoch(df_to, epoch, columns = [])
+
+    xyz, observations, var = get_frame_observations(df_from, df_to, weighted)
+    if not weighted:
+        covariance_blocks = np.broadcast_to(np.eye(3), (len(xyz), 3, 3))
+    elif np.ndim(var) == 3:
+        covariance_blocks = var
     else:
-        parameters = ordinary_least_squares(design_matrix, observation_vector)
+        covariance_blocks = np.eye(3) * var[:, np.newaxis, :]
+
+    normal_equations = NormalEquations(weighted).add_observations(xyz, observations, var)
+    names, normal_matrix, normal_vector, square_sum = normal_equations.reduce(type, custom_dict)
+    parameters, inverse, _ = solve_normal_equations(normal_matrix, normal_vector)
+
+    _, combination, fixed_values = get_parameter_map(type, custom_dict)
+    blocks = get_design_blocks(xyz)
+    residuals = observations - blocks @ (combination @ parameters + fixed_values)
+    blocks = blocks @ combination
+
+    #Station deleted parameters from the 3x3 residual covariance blocks C_i - A_i Q A_i'
+    gain = blocks @ inverse
+    residual_covariance = covariance_blocks - gain @ np.swapaxes(blocks, -1, -2)
 
-    parameters = {parameter : value for parameter, value in zip(design_vectors.keys(), parameters)}
+    #Deleting a station fully determining some parameters leaves a singular residual covariance block
+    singular = np.linalg.cond(residual_covariance) > 1e12
+    if observations.size - 3 - len(names) < 0:
+        singular[:] = True
+    residual_covariance = np.where(singular[:, np.newaxis, np.newaxis], np.eye(3), residual_covariance)
+
+    correction = np.linalg.solve(residual_covariance, residuals[..., np.newaxis])[..., 0]
+    deleted_parameters = parameters - np.einsum("nki,nk->ni", gain, correction)
+    deleted_parameters[singular] = np.nan
+
+    n = len(xyz)
+    deviations = deleted_parameters - deleted_parameters.mean(axis=0)
+    jackknife_sigmas = np.sqrt((n - 1) / n * np.sum(deviations**2, axis=0))
+
+    degrees_of_freedom = observations.size - len(names)
+    unit_variance = (square_sum - parameters @ normal_vector) / degrees_of_freedom if degrees_of_freedom > 0 else np.nan
+    changes = parameters - deleted_parameters
+    influence = np.einsum("ni,ij,nj->n", changes, normal_matrix, changes) / (len(names) * unit_variance)
+
+    uncertainties = {parameter : np.nan for parameter in parameter_names}
+    uncertainties.update({parameter : sigma for parameter, sigma in zip(names, jackknife_sigmas)})
+    deleted_parameters = pd.DataFrame(deleted_parameters, index = df_from.index, columns = names)
+
+    return deleted_parameters, uncertainties, pd.Series(influence, index = df_from.index, name = "Influence")
+
+def compare_models(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, custom_dict: dict = None, epoch: float = None):
+    """Fits the 7, 8 and 9 parameter models to the same stations from one set of 9 column normal equations, the smaller 
+    models follow by summing scale columns of the normal matrix, see get_parameter_map.
+
+    Returns a dict keyed by type holding the parameters, uncertainties, chi squared, degrees of freedom and AIC of each 
+    model, and a dict keyed "7-8", "8-9" and "7-9" of F-tests (statistic and p-value, see f_test) of the smaller model 
+    against the larger one. The AIC is chi squared + 2k for weighted fits and n ln(RSS/n) + 2k for unweighted ones."""
+    normal_equations = NormalEquations(weighted).add_frames(df_from, df_to, epoch)
+    return normal_equations.compare_models(custom_dict)
+
+def f_test(chi_squared_reduced: float, dof_reduced: int, chi_squared_full: float, dof_full: int):
+    """F-test of a reduced model against a full model nesting it, returns the F statistic and its p-value. 
+    Small p-values favour the extra parameters of the full model."""
+    extra = dof_reduced - dof_full
+    if extra <= 0:
+        return {"F" : np.nan, "p_value" : np.nan}
+
+    f = ((chi_squared_reduced - chi_squared_full) / extra) / (chi_squared_full / dof_full)
+    p_value = incomplete_beta(dof_full / 2, extra / 2, dof_full / (dof_full + extra * max(f, 0)))
+    return {"F" : f, "p_value" : p_value}
+
+def incomplete_beta(a: float, b: float, x: float):
+    """Regularized incomplete beta function I_x(a, b) by its continued fraction (modified Lentz)"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1 - incomplete_beta(b, a, 1 - x)
+
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x)
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 1000):
+        for numerator in [m * (b - m) * x / ((a + 2*m - 1) * (a + 2*m)), -(a + m) * (a + b + m) * x / ((a + 2*m) * (a + 2*m + 1))]:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1) < 1e-15:
+            break
+
+    return math.exp(log_front) * fraction / a
+
+similarity_names = ["translation_x", "translation_y", "translation_z", "scale_x", "rotation_x", "rotation_y", "rotation_z"]
+
+def calculate_similarity_parameters(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, custom_dict: dict = None, full_output: bool = False, epoch: float = None, max_iterations: int = 20, tolerance: float = 1e-4):
+    """Calculates the parameters of the exact 7 parameter similarity transform x' = t + (1 + scale_x) Rz Ry Rx x, valid 
+    for large rotations and scales unlike the infinitesimal form of calculate_parameters, see similarity_gauss_newton.
+
+    Returns parameters and uncertainties as calculate_parameters, with full_output a third dict holds the condition 
+    number, chi squared, degrees of freedom, the number of iterations and whether the fit converged."""
+    if epoch is not None:
+        df_from = propagate_epoch(df_from, epoch, columns = [])
+        df_to = propagate_epoch(df_to, epoch, columns = [])
+
+    xyz, observations, var = get_frame_observations(df_from, df_to, weighted)
+    weights = get_station_weights(var, len(xyz), weighted)
+    parameters, covariance, info = similarity_gauss_newton(xyz, xyz + observations, weights, custom_dict, max_iterations, tolerance)
+
+    names = info.pop("names")
+    uncertainties = {parameter : np.nan for parameter in similarity_names}
+    if weighted:
+        uncertainties.update({parameter : sigma for parameter, sigma in zip(names, np.sqrt(np.diag(covariance)))})
+    parameters = {parameter : parameters[similarity_names.index(parameter)] for parameter in names}
+
+    if full_output:
+        return parameters, uncertainties, info
 
     return parameters, uncertainties
 
+def calculate_similarity_parameters_batch(xyz_from, xyz_to, var = None, mask = None, custom_dict: dict = None, max_iterations: int = 20, tolerance: float = 1e-4):
+    """Calculates exact similarity transform parameters for a stack of frame pairs in one vectorized Gauss-Newton 
+    iteration, with arguments and results as calculate_parameters_batch"""
+    xyz_from = np.asarray(xyz_from, dtype=np.float64)
+    xyz_to = np.asarray(xyz_to, dtype=np.float64)
+    shape = np.broadcast_shapes(xyz_from.shape, xyz_to.shape)
+    mask = np.ones(shape[:-1], dtype=bool) if mask is None else np.broadcast_to(mask, shape[:-1])
+
+    weights = np.ones(shape) if var is None else 1/np.asarray(var, dtype=np.float64)
+    weights = np.where(mask[..., np.newaxis], weights, 0)[..., np.newaxis, :] * np.eye(3)
+    valid = mask.sum(axis=-1) >= 3
+    parameters, covariance, info = similarity_gauss_newton(np.broadcast_to(xyz_from, shape), np.where(mask[..., np.newaxis], xyz_to, 0), weights, custom_dict, max_iterations, tolerance, valid)
+
+    names = info["names"]
+    uncertainties = {parameter : np.full(shape[:-2], np.nan) for parameter in similarity_names}
+    if var is not None:
+        sigmas = np.where(valid[..., np.newaxis], np.sqrt(np.diagonal(covariance, axis1=-2, axis2=-1)), np.nan)
+        uncertainties.update({parameter : sigmas[..., j] for j, parameter in enumerate(names)})
+    parameters = {parameter : parameters[..., similarity_names.index(parameter)] for parameter in names}
+
+    return parameters, uncertainties
+
+def similarity_gauss_newton(xyz_from, xyz_to, weights, custom_dict: dict = None, max_iterations: int = 20, tolerance: float = 1e-4, valid = True):
+    """Weighted Gauss-Newton estimation of the exact similarity transform between (..., n, 3) coordinates with 
+    (..., n, 3, 3) weight blocks, parameters of custom_dict are fixed.
+
+    The iteration starts from zero for the estimated parameters, where the linearized model is the infinitesimal 
+    Helmert transform, so the first step is the linear solution. It stops once no parameter changes by more than 
+    tolerance times its sigma or after max_iterations. Stacks where valid is False give nan. Returns the (..., 7) 
+    parameters ordered as similarity_names, the covariance of the estimated ones and an info dict."""
+    custom_dict = custom_dict or {}
+    if any(isinstance(custom_dict.get(name), tuple) for name in similarity_names):
+        raise ValueError("Soft constraints are not supported by the exact similarity transform")
+
+    names = [name for name in similarity_names if custom_dict.get(name) is None]
+    free = [similarity_names.index(name) for name in names]
+    valid = np.asarray(valid)
+
+    parameters = np.zeros((*xyz_from.shape[:-2], len(similarity_names)))
+    parameters[..., :] = [0 if custom_dict.get(name) is None else custom_dict[name] for name in similarity_names]
+
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        jacobian, residuals = get_similarity_jacobian(xyz_from, xyz_to, parameters)
+        jacobian = jacobian[..., free]
+
+        normal_matrix = np.einsum("...nki,...nkl,...nlj->...ij", jacobian, weights, jacobian, optimize=True)
+        normal_vector = np.einsum("...nki,...nkl,...nl->...i", jacobian, weights, residuals, optimize=True)
+        normal_matrix = np.where(valid[..., np.newaxis, np.newaxis], normal_matrix, np.eye(len(names)))
+        normal_vector = np.where(valid[..., np.newaxis], normal_vector, 0)
+        step, covariance, condition_number = solve_normal_equations(normal_matrix, normal_vector)
+        parameters[..., free] += step
+
+        if np.all(np.abs(step) <= tolerance * np.sqrt(np.diagonal(covariance, axis1=-2, axis2=-1))):
+            converged = True
+            break
+
+    _, residuals = get_similarity_jacobian(xyz_from, xyz_to, parameters)
+    chi_squared = np.einsum("...nk,...nkl,...nl->...", residuals, weights, residuals)
+    parameters = np.where(valid[..., np.newaxis], parameters, np.nan)
+
+    info = {"names" : names,
+            "solver" : "gauss-newton",
+            "condition_number" : condition_number,
+            "chi_squared" : chi_squared,
+            "degrees_of_freedom" : 3 * xyz_from.shape[-2] - len(names),
+            "iterations" : iteration,
+            "converged" : converged}
+
+    return parameters, covariance, info
+
+def get_similarity_jacobian(xyz_from, xyz_to, parameters):
+    """Returns the (..., n, 3, 7) jacobian of the similarity transform with respect to its parameters (ordered as 
+    similarity_names) and the (..., n, 3) residuals xyz_to - transform(xyz_from)"""
+    translation, scale, rotation_angles = parameters[..., 0:3], parameters[..., 3], parameters[..., 4:7]
+    rotation, derivatives = get_rotation_matrix(rotation_angles[..., 0], rotation_angles[..., 1], rotation_angles[..., 2], derivatives = True)
+
+    rotated = xyz_from @ np.swapaxes(rotation, -1, -2)
+    residuals = xyz_to - translation[..., np.newaxis, :] - (1 + scale)[..., np.newaxis, np.newaxis] * rotated
+
+    jacobian = np.empty((*np.broadcast_shapes(xyz_from.shape, residuals.shape), len(similarity_names)))
+    jacobian[..., 0:3] = np.eye(3)
+    jacobian[..., 3] = rotated
+    for k in range(3):
+        jacobian[..., 4 + k] = (1 + scale)[..., np.newaxis, np.newaxis] * (xyz_from @ np.swapaxes(derivatives[k], -1, -2))
+
+    return jacobian, residuals
+
 def get_observation_vector(df_from: pd.DataFrame, df_to: pd.DataFrame):
     """Creates an observation matrix for an OLS parameter fitting of a Helmert-transform"""
     observation_matrix = np.hstack((df_to.X-df_from.X, df_to.Y-df_from.Y, df_to.Z-df_from.Z))
@@ -74,8 +468,100 @@ def get_design_columns(df: pd.DataFrame):
         
     return result
 
-def get_var_matrix(df_from: pd.DataFrame, df_to: pd.DataFrame):
-    """Creates a weight matrix for a WLS parameter fitting of a Helmer transform""" 
+def get_design_blocks(xyz):
+    """Creates the 3x9 design block of every station from an (..., n, 3) coordinate array, columns ordered as parameter_names"""
+    xyz = np.asarray(xyz, dtype=np.float64)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    blocks = np.zeros(xyz.shape + (9,))
+
+    blocks[..., 0, 0] = 1
+    blocks[..., 1, 1] = 1
+    blocks[..., 2, 2] = 1
+    blocks[..., 0, 3] = x
+    blocks[..., 1, 4] = y
+    blocks[..., 2, 5] = z
+    blocks[..., 1, 6] = -z
+    blocks[..., 2, 6] = y
+    blocks[..., 0, 7] = z
+    blocks[..., 2, 7] = -x
+    blocks[..., 0, 8] = -y
+    blocks[..., 1, 8] = x
+
+    return blocks
+
+def get_station_weights(var, n: int, weighted: bool = True):
+    """Returns the (n, 3, 3) weight blocks of the stations from (n, 3) observation variances or (n, 3, 3) covariance 
+    blocks, identity blocks if not weighted"""
+    if not weighted:
+        return np.broadcast_to(np.eye(3), (n, 3, 3))
+    elif np.ndim(var) == 3:
+        return np.linalg.inv(var)
+    else:
+        return np.eye(3) / np.asarray(var, dtype=np.float64)[..., np.newaxis, :]
+
+def get_station_normals(blocks, weights, observations):
+    """Returns the per station contributions to the normal matrix, normal vector and weighted observation square sum 
+    from (..., n, 3, 9) design blocks, (n, 3, 3) weight blocks and (..., n, 3) observations"""
+    normal_matrix = np.einsum("...nki,nkl,...nlj->...nij", blocks, weights, blocks, optimize=True)
+    normal_vector = np.einsum("...nki,nkl,...nl->...ni", blocks, weights, observations, optimize=True)
+    square_sum = np.einsum("...nk,nkl,...nl->...n", observations, weights, observations, optimize=True)
+
+    return normal_matrix, normal_vector, square_sum
+
+def get_parameter_map(type: str, custom_dict: dict = None):
+    """Maps the nine Helmert parameters onto the parameters estimated for a 7, 8 or 9 parameter fit with custom values.
+
+    Returns the names of the estimated parameters, a 9xk matrix combining the nine design columns into the k estimated 
+    ones and a vector of the nine custom values (zero where estimated). A 9 column design matrix A and observations y 
+    then reduce to A @ combination and y - A @ fixed_values. Soft constrained (value, sigma) parameters are estimated, 
+    see add_soft_constraints."""
+    if not custom_dict:
+        custom_dict = {}
+    fixed = {name : custom_dict.get(name) for name in parameter_names}
+    fixed = {name : None if isinstance(value, tuple) else value for name, value in fixed.items()}
+    fixed_values = np.array([0 if value is None else value for value in fixed.values()], dtype=np.float64)
+
+    columns = {name : [name] for name, value in fixed.items() if value is None}
+
+    #Merge columns, scale_x is really scale_xyz or scale_xy here
+    merged_scales = {"7" : ["scale_y", "scale_z"], "8" : ["scale_y"]}.get(type, [])
+    if "scale_x" in columns:
+        for name in merged_scales:
+            if name in columns:
+                columns["scale_x"].append(name)
+                del columns[name]
+
+    combination = np.zeros((len(parameter_names), len(columns)))
+    for j, merged_names in enumerate(columns.values()):
+        for name in merged_names:
+            combination[parameter_names.index(name), j] = 1
+
+    return list(columns), combination, fixed_values
+
+def get_constraint_rows(names: list, custom_dict: dict = None):
+    """Returns the (m, k) rows, values and sigmas of the soft constraints of the estimated parameters names, given as 
+    (value, sigma) tuples in custom_dict"""
+    constraints = {name : value for name, value in (custom_dict or {}).items() if isinstance(value, tuple) and name in names}
+    rows = np.zeros((len(constraints), len(names)))
+    for i, name in enumerate(constraints):
+        rows[i, names.index(name)] = 1
+    values = np.array([value for value, _ in constraints.values()], dtype=np.float64)
+    sigmas = np.array([sigma for _, sigma in constraints.values()], dtype=np.float64)
+
+    return rows, values, sigmas
+
+def add_soft_constraints(names: list, normal_matrix, normal_vector, square_sum, custom_dict: dict = None):
+    """Adds the soft constraints of custom_dict as pseudo observations to (stacks of) reduced normal equations, 
+    returns the normal matrix, normal vector, square sum and the number of constraints"""
+    rows, values, sigmas = get_constraint_rows(names, custom_dict)
+    normal_matrix = normal_matrix + rows.T @ (rows / sigmas[:, np.newaxis]**2)
+    normal_vector = normal_vector + rows.T @ (values / sigmas**2)
+    square_sum = square_sum + np.sum((values / sigmas)**2)
+
+    return normal_matrix, normal_vector, square_sum, len(values)
+
+def get_var_vector(df_from: pd.DataFrame, df_to: pd.DataFrame):
+    """Creates a vector of observation variances for a WLS parameter fitting of a Helmert transform, ordered as the observation vector"""
     var1 = df_from.X_sigma**2 + df_to.X_sigma**2
     var2 = df_from.Y_sigma**2 + df_to.Y_sigma**2 
     var3 = df_from.Z_sigma**2 + df_to.Z_sigma**2 
@@ -84,33 +570,130 @@ def get_var_matrix(df_from: pd.DataFrame, df_to: pd.DataFrame):
     # var = np.sqrt(df_from.X_sigma**2 + df_to.X_sigma**2 + df_from.Y_sigma**2 + df_to.Y_sigma**2 + df_from.Z_sigma**2 + df_to.Z_sigma**2) 
     # var = np.hstack([var, var, var])
 
-    weight_matrix = np.diag(var)
+    return var
+
+def get_var_matrix(df_from: pd.DataFrame, df_to: pd.DataFrame):
+    """Creates a dense diagonal variance matrix for a WLS parameter fitting of a Helmer transform, prefer get_var_vector for large frames""" 
+    weight_matrix = np.diag(get_var_vector(df_from, df_to))
     
     return weight_matrix
 
-def helmert_transform(df: pd.DataFrame, parameters):
-    """Returns a new dataframe with coordinates transformed according tp the helmert infinitecimal form"""
-    X = np.vstack((df.X, df.Y, df.Z)) 
-    
-    if not "scale_y" in parameters:
-        parameters["scale_y"] = parameters["scale_x"]
-    if not "scale_z" in parameters:
-        parameters["scale_z"] = parameters["scale_x"]
-    
-    translation = np.array([parameters["translation_x"],parameters["translation_y"],parameters["translation_z"]]).reshape(3,1)
-    scale = np.array([parameters["scale_x"],parameters["scale_y"],parameters["scale_z"]]).reshape(3,1)
-    rotation = np.array([parameters["rotation_x"],parameters["rotation_y"],parameters["rotation_z"]]).reshape(3,1)
-
-    coords = X + translation + scale * X + np.cross(rotation, X, axis=0)
-    transformed_df = pd.DataFrame({"X": coords[0,:], 
-                                   "Y" : coords[1,:], 
-                                   "Z" : coords[2,:], 
+def get_covariance_blocks(df_from: pd.DataFrame, df_to: pd.DataFrame, velocity: bool = False):
+    """Creates the (n, 3, 3) observation covariance blocks for a WLS parameter fitting of a Helmert transform with correlated X, Y and Z errors"""
+    return get_frame_covariance(df_from, velocity) + get_frame_covariance(df_to, velocity)
+
+def get_frame_covariance(df: pd.DataFrame, velocity: bool = False):
+    """Returns the (n, 3, 3) coordinate covariance blocks of a frame from its sigma and XY_cov, XZ_cov and YZ_cov columns, 
+    or from the X_v_sigma and XY_v_cov style columns of the velocities"""
+    suffix = "_v" if velocity else ""
+    blocks = np.zeros((len(df.index), 3, 3))
+    for i, axis in enumerate("XYZ"):
+        blocks[:, i, i] = df[axis + suffix + "_sigma"]**2
+
+    for (i, j), name in {(0, 1) : "XY", (0, 2) : "XZ", (1, 2) : "YZ"}.items():
+        if name + suffix + "_cov" in df:
+            blocks[:, i, j] = df[name + suffix + "_cov"]
+            blocks[:, j, i] = df[name + suffix + "_cov"]
+
+    return blocks
+
+def get_frame_observations(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, velocity: bool = False):
+    """Returns the (n, 3) design coordinates, observed differences and observation variances (or (n, 3, 3) covariance 
+    blocks, None if unweighted) of two aligned frames, of the velocities if velocity"""
+    suffix = "_v" if velocity else ""
+    columns = [axis + suffix for axis in "XYZ"]
+    sigma_columns = [axis + suffix + "_sigma" for axis in "XYZ"]
+
+    var = None
+    if weighted and (has_covariance(df_from, velocity) or has_covariance(df_to, velocity)):
+        var = get_covariance_blocks(df_from, df_to, velocity)
+    elif weighted:
+        var = df_from[sigma_columns].to_numpy()**2 + df_to[sigma_columns].to_numpy()**2
+
+    observations = df_to[columns].to_numpy() - df_from[columns].to_numpy()
+    return df_from[["X", "Y", "Z"]].to_numpy(), observations, var
+
+def has_covariance(df: pd.DataFrame, velocity: bool = False):
+    """Checks if a frame holds covariances between its X, Y and Z coordinates (or velocities)"""
+    suffix = "_v" if velocity else ""
+    return any(name + suffix + "_cov" in df for name in ["XY", "XZ", "YZ"])
+
+def helmert_transform(df: pd.DataFrame, parameters, exact: bool = False):
+    """Returns a new dataframe with coordinates transformed according tp the helmert infinitecimal form, or the exact 
+    similarity transform if exact, see transform_array"""
+    coords = transform_array(df[["X", "Y", "Z"]].to_numpy(dtype=np.float64), parameters, exact = exact)
+    transformed_df = pd.DataFrame({"X": coords[:,0], 
+                                   "Y" : coords[:,1], 
+                                   "Z" : coords[:,2], 
                                    "Station_Name" : df.Station_Name})
 
     transformed_df = calculate_long_lat(transformed_df)
 
     return transformed_df
 
+def transform_array(xyz, parameters, out = None, exact: bool = False):
+    """Transforms (..., n, 3) coordinates by the infinitesimal Helmert transform of parameters in a single matmul, or 
+    by the exact similarity transform if exact (see get_similarity_matrix). 
+
+    The result is written to out if given, which may be xyz itself to transform in place. Missing scale_y and 
+    scale_z default to scale_x as for 7 parameter fits. Parameters may be arrays, e.g. from a batch fit, to transform 
+    a matching stack of coordinates."""
+    matrix, translation = get_similarity_matrix(parameters) if exact else get_transform_matrix(parameters)
+    out = np.matmul(xyz, np.swapaxes(matrix, -1, -2), out = out)
+    out += translation[..., np.newaxis, :] if matrix.ndim > 2 else translation
+
+    return out
+
+def get_transform_matrix(parameters):
+    """Returns the 3x3 matrix M = I + diag(scale) + [rotation]x and translation t of the infinitesimal Helmert transform x' = M x + t"""
+    scale_x = np.asarray(parameters["scale_x"], dtype=np.float64)
+    scale = np.stack(np.broadcast_arrays(scale_x, parameters.get("scale_y", scale_x), parameters.get("scale_z", scale_x)), axis=-1)
+
+    matrix = np.eye(3) + scale[..., np.newaxis] * np.eye(3) + get_cross_matrix(parameters["rotation_x"], parameters["rotation_y"], parameters["rotation_z"])
+    translation = np.stack(np.broadcast_arrays(parameters["translation_x"], parameters["translation_y"], parameters["translation_z"]), axis=-1).astype(np.float64)
+
+    return matrix, translation
+
+def get_similarity_matrix(parameters):
+    """Returns the 3x3 matrix M = (1 + scale_x) R and translation t of the exact similarity transform x' = M x + t, 
+    where R = Rz Ry Rx (see get_rotation_matrix) tends to I + [rotation]x for small angles"""
+    rotation = get_rotation_matrix(parameters["rotation_x"], parameters["rotation_y"], parameters["rotation_z"])
+    matrix = (1 + np.asarray(parameters["scale_x"], dtype=np.float64))[..., np.newaxis, np.newaxis] * rotation
+    translation = np.stack(np.broadcast_arrays(parameters["translation_x"], parameters["translation_y"], parameters["translation_z"]), axis=-1).astype(np.float64)
+
+    return matrix, translation
+
+def get_cross_matrix(rotation_x, rotation_y, rotation_z):
+    """Returns the (..., 3, 3) cross product matrices [r]x of rotations, [r]x @ x = r cross x"""
+    rotation_x, rotation_y, rotation_z = np.broadcast_arrays(*[np.asarray(value, dtype=np.float64) for value in [rotation_x, rotation_y, rotation_z]])
+    zero = np.zeros_like(rotation_x)
+    return np.stack([np.stack([zero, -rotation_z, rotation_y], axis=-1),
+                     np.stack([rotation_z, zero, -rotation_x], axis=-1),
+                     np.stack([-rotation_y, rotation_x, zero], axis=-1)], axis=-2)
+
+def get_rotation_matrix(rotation_x, rotation_y, rotation_z, derivatives: bool = False):
+    """Returns the (..., 3, 3) rotation matrices R = Rz Ry Rx of (arrays of) angles in radians about the X, Y and Z axes. 
+    With derivatives a (3, ..., 3, 3) array of the derivatives of R with respect to the three angles is returned too."""
+    def axis_rotation(angle, i, j):
+        angle = np.asarray(angle, dtype=np.float64)
+        cos, sin = np.cos(angle)[..., np.newaxis, np.newaxis], np.sin(angle)[..., np.newaxis, np.newaxis]
+        unit = np.zeros((3, 3)); unit[i, i] = unit[j, j] = 1
+        generator = np.zeros((3, 3)); generator[i, j] = -1; generator[j, i] = 1
+        rotation = np.eye(3) - unit + cos * unit + sin * generator
+        derivative = -sin * unit + cos * generator
+        return rotation, derivative
+
+    rotation_x, derivative_x = axis_rotation(rotation_x, 1, 2)
+    rotation_y, derivative_y = axis_rotation(rotation_y, 2, 0)
+    rotation_z, derivative_z = axis_rotation(rotation_z, 0, 1)
+    rotation = rotation_z @ rotation_y @ rotation_x
+
+    if derivatives:
+        return rotation, np.stack(np.broadcast_arrays(rotation_z @ rotation_y @ derivative_x, 
+                                                      rotation_z @ derivative_y @ rotation_x, 
+                                                      derivative_z @ rotation_y @ rotation_x))
+    return rotation
+
 def calculate_residuals(df_from: pd.DataFrame, df_to: pd.DataFrame):
     """Returns the from dataframe with computed residuals"""
     df_from["dX"] = df_from.X-df_to.X
@@ -120,35 +703,350 @@ def calculate_residuals(df_from: pd.DataFrame, df_to: pd.DataFrame):
     return df_from
 
 def decompose_residuals(df):
-    """Returns the dataframe with residuals decomposed into U,E,N coordinates"""
-    LONG = np.radians(df.LONG)
-    LAT = np.radians(df.LAT)
-    
-    df["dU"] = np.cos(LAT)*np.cos(LONG)*df.dX + \
-                np.cos(LAT)*np.sin(LONG)*df.dY + \
-                np.sin(LAT)*df.dZ
-    df["dE"] = -np.sin(LONG)*df.dX + \
-                np.cos(LONG)*df.dY + \
-             0
-    df["dN"] = -np.sin(LAT)*np.cos(LONG)*df.dX + \
-               -np.sin(LAT)*np.sin(LONG)*df.dY + \
-               -(-np.cos(LAT)*np.cos(LONG)*np.cos(LONG)-np.cos(LAT)*np.sin(LONG)*np.sin(LONG))*df.dZ
+    """Returns the dataframe with residuals decomposed into U,E,N coordinates of the local geodetic frame at each station"""
+    enu = np.einsum("nij,nj->ni", get_enu_matrices(df[["X", "Y", "Z"]].to_numpy(dtype=np.float64)), df[["dX", "dY", "dZ"]].to_numpy(dtype=np.float64))
+
+    df["dU"] = enu[:, 2]
+    df["dE"] = enu[:, 0]
+    df["dN"] = enu[:, 1]
     
     return df
 
-def ordinary_least_squares(design_matrix, observation_matrix, parameter_names = None):
+#Rotation matrices of recently decomposed station sets, keyed by their positions rounded to enu_cache_resolution metres
+enu_cache = OrderedDict()
+enu_cache_lock = threading.Lock()
+enu_cache_size = 16
+enu_cache_resolution = 1.0
+
+def get_enu_matrices(xyz, ellipsoid: str = "GRS80"):
+    """Returns the (n, 3, 3) rotation matrices from geocentric XYZ into local east, north and up at (n, 3) positions. 
+
+    The matrices are cached by position (rounded to enu_cache_resolution, far below where the local frame changes 
+    noticeably), so decomposing the residuals of many fits of the same stations computes the trigonometry once. The 
+    returned matrices are shared between callers (also across threads) and read-only."""
+    xyz = np.asarray(xyz, dtype=np.float64)
+    key = (ellipsoid, hashlib.blake2b(np.round(xyz / enu_cache_resolution).tobytes(), digest_size=16).hexdigest())
+    with enu_cache_lock:
+        if key in enu_cache:
+            enu_cache.move_to_end(key)
+            return enu_cache[key]
+
+    lat, long, _ = ecef_to_geodetic(xyz, ellipsoid)
+    lat, long = np.radians(lat), np.radians(long)
+    sin_lat, cos_lat, sin_long, cos_long = np.sin(lat), np.cos(lat), np.sin(long), np.cos(long)
+
+    matrices = np.empty((len(xyz), 3, 3))
+    matrices[:, 0] = np.stack([-sin_long, cos_long, np.zeros_like(long)], axis=-1)
+    matrices[:, 1] = np.stack([-sin_lat * cos_long, -sin_lat * sin_long, cos_lat], axis=-1)
+    matrices[:, 2] = np.stack([cos_lat * cos_long, cos_lat * sin_long, sin_lat], axis=-1)
+
+    matrices.setflags(write=False)
+
+    with enu_cache_lock:
+        enu_cache[key] = matrices
+        while len(enu_cache) > enu_cache_size:
+            enu_cache.popitem(last=False)
+
+    return matrices
+
+def ordinary_least_squares(design_matrix, observation_matrix, parameter_names = None, solver = "cholesky"):
     """Ordinary least squares fit"""
-    parameters = np.linalg.inv(design_matrix.T @ design_matrix) @ design_matrix.T @ observation_matrix
+    parameters, _, _ = least_squares(design_matrix, observation_matrix, None, solver)
 
     return parameters
 
-def weighted_least_squares(design_matrix, observation_matrix, observation_var_matrix, parameter_names = None):
-    """Weighted least squares fit under the assumption of uncorrelated measurement errors"""
-    weight_matrix = np.linalg.inv(observation_var_matrix)
+def weighted_least_squares(design_matrix, observation_matrix, observation_var_matrix, parameter_names = None, solver = "cholesky"):
+    """Weighted least squares fit under the assumption of uncorrelated measurement errors.
 
-    parameter_uncertainties = np.linalg.inv(design_matrix.T @ weight_matrix @ design_matrix)
-    parameters = parameter_uncertainties @ design_matrix.T @ weight_matrix @ observation_matrix
+    observation_var_matrix may be a vector of observation variances, in which case the normal equations are formed by 
+    scaling the rows of the design matrix (linear in the number of observations), or a dense variance matrix."""
+    parameters, parameter_uncertainties, _ = least_squares(design_matrix, observation_matrix, observation_var_matrix, solver)
     parameter_uncertainties = np.sqrt(np.diag(parameter_uncertainties))
 
     return parameters, parameter_uncertainties
 
+def least_squares(design_matrix, observation_vector, observation_var = None, solver = "cholesky", constraints = None):
+    """Least squares fit with a selectable solver backend, returns parameters, their covariance and the condition number.
+
+    The observations are whitened by observation_var before being passed to one of the functions in solvers. It is 
+    either a vector of variances, (n, 3, 3) per station covariance blocks for observations ordered as 
+    get_observation_vector, a dense variance matrix, or None for an unweighted fit. The covariance is only meaningful 
+    for weighted fits. constraints holds the rows, values and sigmas of soft constraints, see get_constraint_rows."""
+    if not solver in solvers:
+        raise ValueError(f"Unknown solver '{solver}', expected one of {list(solvers)}")
+
+    design_matrix, observation_vector = whiten(design_matrix, observation_vector, observation_var)
+    design_matrix, observation_vector = append_constraints(design_matrix, observation_vector, constraints)
+
+    return solvers[solver](design_matrix, observation_vector)
+
+def append_constraints(design_matrix, observation_vector, constraints = None):
+    """Appends soft constraints (rows, values, sigmas) as whitened pseudo observations to a whitened least squares problem"""
+    if constraints is None or len(constraints[1]) == 0:
+        return design_matrix, observation_vector
+
+    rows, values, sigmas = constraints
+    return np.vstack((design_matrix, rows / sigmas[:, np.newaxis])), np.concatenate((observation_vector, values / sigmas))
+
+def whiten(design_matrix, observation_vector, observation_var = None):
+    """Returns the design matrix and observations scaled by the inverse Cholesky factor of observation_var, as least_squares"""
+    design_matrix = np.asarray(design_matrix, dtype=np.float64)
+    observation_vector = np.asarray(observation_vector, dtype=np.float64)
+
+    if observation_var is not None:
+        observation_var = np.asarray(observation_var, dtype=np.float64)
+        if observation_var.ndim == 1:
+            scale = 1/np.sqrt(observation_var)
+            design_matrix = design_matrix * scale.reshape(-1, 1)
+            observation_vector = observation_vector * scale.reshape(observation_vector.shape[0], *[1]*(observation_vector.ndim-1))
+        elif observation_var.ndim == 3:
+            #Whiten station by station, observations are ordered as all X, all Y and then all Z components
+            n = len(observation_var)
+            lower = np.linalg.cholesky(observation_var)
+            design_matrix = np.linalg.solve(lower, design_matrix.reshape(3, n, -1).transpose(1, 0, 2)).transpose(1, 0, 2).reshape(design_matrix.shape)
+            observation_vector = np.linalg.solve(lower, observation_vector.reshape(3, n, -1).transpose(1, 0, 2)).transpose(1, 0, 2).reshape(observation_vector.shape)
+        else:
+            lower = np.linalg.cholesky(observation_var)
+            design_matrix = np.linalg.solve(lower, design_matrix)
+            observation_vector = np.linalg.solve(lower, observation_vector)
+
+    return design_matrix, observation_vector
+
+def robust_least_squares(design_matrix, observation_vector, observation_var = None, robust: str = "huber", solver: str = "cholesky", max_iterations: int = 50, tolerance: float = 1e-6, constraints = None):
+    """M-estimator fit by iteratively reweighted least squares of observations ordered as get_observation_vector.
+
+    The design matrix is whitened once, each iteration only rescales the rows of a station by the square root of its 
+    weight from robust_weights, evaluated on the normalized station residual sqrt(v'Pv / 3) over a robust scale 
+    (median based) of all stations. Stops once no parameter changes by more than tolerance times its sigma or after 
+    max_iterations. Soft constraints are never down weighted. Returns parameters, covariance and condition number as 
+    least_squares and a dict with the per station weights, the number of iterations and whether the fit converged."""
+    if not robust in robust_weights:
+        raise ValueError(f"Unknown robust estimator '{robust}', expected one of {list(robust_weights)}")
+    if not solver in solvers:
+        raise ValueError(f"Unknown solver '{solver}', expected one of {list(solvers)}")
+
+    design_matrix, observation_vector = whiten(design_matrix, observation_vector, observation_var)
+    n = len(observation_vector) // 3
+    design_matrix, observation_vector = append_constraints(design_matrix, observation_vector, constraints)
+    n_constraints = len(observation_vector) - 3 * n
+    station_weights = np.ones(n)
+    parameters, covariance, condition_number = solvers[solver](design_matrix, observation_vector)
+
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        residuals = (observation_vector - design_matrix @ parameters)[:3 * n].reshape(3, n)
+        station_residuals = np.sqrt(np.sum(residuals**2, axis=0) / 3)
+
+        #The median of sqrt(chi2(3)/3) makes the scale consistent for normally distributed residuals
+        scale = np.median(station_residuals) / 0.8880
+        station_weights = robust_weights[robust](station_residuals / max(scale, np.finfo(float).tiny))
+        row_weights = np.sqrt(np.concatenate((np.tile(station_weights, 3), np.ones(n_constraints))))
+
+        previous = parameters
+        parameters, covariance, condition_number = solvers[solver](design_matrix * row_weights[:, np.newaxis], observation_vector * row_weights)
+        if np.all(np.abs(parameters - previous) <= tolerance * np.sqrt(np.diag(covariance))):
+            converged = True
+            break
+
+    info = {"robust" : robust, "station_weights" : station_weights, "iterations" : iteration, "converged" : converged}
+    return parameters, covariance, condition_number, info
+
+def huber_weights(residuals, tuning: float = 1.345):
+    """Huber weights of normalized residuals, one within tuning and decaying as tuning/|u| outside"""
+    return np.minimum(1, tuning / np.maximum(np.abs(residuals), np.finfo(float).tiny))
+
+def tukey_weights(residuals, tuning: float = 4.685):
+    """Tukey biweight weights of normalized residuals, zero beyond tuning"""
+    return np.where(np.abs(residuals) < tuning, (1 - (residuals / tuning)**2)**2, 0)
+
+robust_weights = {"huber" : huber_weights, "tukey" : tukey_weights}
+
+def solve_normal_equations(normal_matrix, normal_vector):
+    """Solves the normal equations N x = b through a Cholesky factorization of the column equilibrated normal matrix.
+    
+    Returns the parameters, the inverse normal matrix and the condition number of the equilibrated design matrix. 
+    Stacks of normal equations (..., k, k) and (..., k) are solved in one pass."""
+    normal_matrix = np.asarray(normal_matrix, dtype=np.float64)
+    normal_vector = np.asarray(normal_vector, dtype=np.float64)
+
+    column_scale = get_column_scale(np.sqrt(np.diagonal(normal_matrix, axis1=-2, axis2=-1)))
+    scale_matrix = column_scale[..., :, np.newaxis] * column_scale[..., np.newaxis, :]
+    scaled_matrix = normal_matrix * scale_matrix
+
+    lower = np.linalg.cholesky(scaled_matrix)
+    lower_inverse = np.linalg.solve(lower, np.broadcast_to(np.eye(lower.shape[-1]), lower.shape))
+    scaled_inverse = np.swapaxes(lower_inverse, -1, -2) @ lower_inverse
+
+    parameters = column_scale * (scaled_inverse @ (column_scale * normal_vector)[..., np.newaxis])[..., 0]
+    covariance = scaled_inverse * scale_matrix
+    condition_number = np.sqrt(np.linalg.cond(scaled_matrix))
+
+    return parameters, covariance, condition_number
+
+def cholesky_solver(design_matrix, observation_vector):
+    """Least squares through the Cholesky factorization of the normal equations, fast and stable for the well scaled Helmert problem"""
+    return solve_normal_equations(design_matrix.T @ design_matrix, design_matrix.T @ observation_vector)
+
+def qr_solver(design_matrix, observation_vector):
+    """Least squares through a QR factorization of the column scaled design matrix, avoids squaring the condition number"""
+    column_scale = get_column_scale(np.linalg.norm(design_matrix, axis=0))
+    q, r = np.linalg.qr(design_matrix * column_scale)
+
+    r_inverse = np.linalg.solve(r, np.eye(len(r)))
+    parameters = column_scale * (r_inverse @ (q.T @ observation_vector))
+    covariance = (r_inverse @ r_inverse.T) * np.outer(column_scale, column_scale)
+    condition_number = np.linalg.cond(r)
+
+    return parameters, covariance, condition_number
+
+def lstsq_solver(design_matrix, observation_vector):
+    """Least squares through a singular value decomposition of the column scaled design matrix, the most robust for rank deficient fits"""
+    column_scale = get_column_scale(np.linalg.norm(design_matrix, axis=0))
+    u, s, vt = np.linalg.svd(design_matrix * column_scale, full_matrices=False)
+
+    #Drop singular values below the numpy.linalg.lstsq cutoff, giving the minimum norm solution
+    s_inverse = np.where(s > s[0] * np.finfo(np.float64).eps * max(design_matrix.shape), 1/s, 0)
+    parameters = column_scale * (vt.T @ (s_inverse * (u.T @ observation_vector)))
+    covariance = ((vt.T * s_inverse**2) @ vt) * np.outer(column_scale, column_scale)
+    condition_number = s[0]/s[-1]
+
+    return parameters, covariance, condition_number
+
+def get_column_scale(column_norms):
+    """Returns factors scaling the columns of a design matrix to unit norm, leaving empty columns untouched"""
+    column_norms = np.asarray(column_norms, dtype=np.float64)
+    return 1/np.where(column_norms > 0, column_norms, 1)
+
+solvers = {"cholesky" : cholesky_solver, 
+           "qr" : qr_solver,
+           "lstsq" : lstsq_solver}
+
+class NormalEquations:
+    """Accumulator of the nine parameter Helmert normal equations, ingesting stations in chunks in constant memory.
+
+    Only the 9x9 normal matrix, the right hand side and the weighted square sum of the observations are kept, so 
+    accumulators filled in different processes can be merged with + and solved for any 7, 8 or 9 parameter fit."""
+
+    def __init__(self, weighted: bool = True):
+        self.weighted = weighted
+        self.normal_matrix = np.zeros((9, 9))
+        self.normal_vector = np.zeros(9)
+        self.observation_square_sum = 0.0
+        self.n_observations = 0
+
+    def add(self, xyz_from, xyz_to, var = None):
+        """Add stations from (n, 3) coordinate arrays, var holds the (n, 3) observation variances or (n, 3, 3) covariance blocks of a weighted fit"""
+        observations = np.asarray(xyz_to, dtype=np.float64) - np.asarray(xyz_from, dtype=np.float64)
+        return self.add_observations(xyz_from, observations, var)
+
+    def add_observations(self, xyz_from, observations, var = None):
+        """Add stations from an (n, 3) coordinate array of the design and (n, 3) observed coordinate (or velocity) differences"""
+        blocks = get_design_blocks(xyz_from)
+        observations = np.asarray(observations, dtype=np.float64)
+
+        if not self.weighted:
+            weighted_blocks, weighted_observations = blocks, observations
+        elif var is None:
+            raise ValueError("Observation variances are required for a weighted fit")
+        elif np.ndim(var) == 3:
+            weights = np.linalg.inv(var)
+            weighted_blocks = weights @ blocks
+            weighted_observations = np.einsum("nkl,nl->nk", weights, observations)
+        else:
+            weights = 1/np.asarray(var, dtype=np.float64)
+            weighted_blocks = blocks * weights[..., np.newaxis]
+            weighted_observations = observations * weights
+
+        self.normal_matrix += np.einsum("nki,nkj->ij", weighted_blocks, blocks)
+        self.normal_vector += np.einsum("nki,nk->i", weighted_blocks, observations)
+        self.observation_square_sum += np.sum(weighted_observations * observations)
+        self.n_observations += observations.size
+
+        return self
+
+    def add_frames(self, df_from: pd.DataFrame, df_to: pd.DataFrame, epoch: float = None, velocity: bool = False):
+        """Add stations from two aligned frames, propagated to epoch if given. With velocity the velocity differences 
+        are observed instead, for the rates of a kinematic fit"""
+        if epoch is not None:
+            df_from = propagate_epoch(df_from, epoch, columns = [])
+            df_to = propagate_epoch(df_to, epoch, columns = [])
+
+        return self.add_observations(*get_frame_observations(df_from, df_to, self.weighted, velocity))
+
+    def add_chunks(self, chunks):
+        """Add stations from an iterable of chunks, e.g. a generator over a file reader. 
+        
+        Each chunk is either a (df_from, df_to) pair of aligned frames or a (xyz_from, xyz_to[, var]) tuple of arrays."""
+        for chunk in chunks:
+            if isinstance(chunk[0], pd.DataFrame):
+                self.add_frames(*chunk)
+            else:
+                self.add(*chunk)
+
+        return self
+
+    def __add__(self, other):
+        if self.weighted != other.weighted:
+            raise ValueError("Can not merge weighted and unweighted normal equations")
+
+        result = NormalEquations(self.weighted)
+        result.normal_matrix = self.normal_matrix + other.normal_matrix
+        result.normal_vector = self.normal_vector + other.normal_vector
+        result.observation_square_sum = self.observation_square_sum + other.observation_square_sum
+        result.n_observations = self.n_observations + other.n_observations
+
+        return result
+
+    def reduce(self, type: str, custom_dict: dict = None):
+        """Returns the parameter names, normal matrix, right hand side and observation square sum of a 7, 8 or 9 parameter 
+        fit with custom values, fixed parameters are partitioned out and soft constrained ones added as pseudo observations"""
+        names, combination, fixed_values = get_parameter_map(type, custom_dict)
+
+        normal_vector = self.normal_vector - self.normal_matrix @ fixed_values
+        square_sum = self.observation_square_sum - 2 * fixed_values @ self.normal_vector + fixed_values @ self.normal_matrix @ fixed_values
+
+        return names, *add_soft_constraints(names, combination.T @ self.normal_matrix @ combination, combination.T @ normal_vector, square_sum, custom_dict)[:3]
+
+    def solve(self, type: str, custom_dict: dict = None, full_output: bool = False):
+        """Solves the accumulated normal equations, returning parameters and uncertainties as calculate_parameters"""
+        names, normal_matrix, normal_vector, square_sum = self.reduce(type, custom_dict)
+        parameters, covariance, condition_number = solve_normal_equations(normal_matrix, normal_vector)
+
+        uncertainties = {parameter : np.nan for parameter in parameter_names}
+        if self.weighted:
+            uncertainties.update({parameter : sigma for parameter, sigma in zip(names, np.sqrt(np.diag(covariance)))})
+        parameters = {parameter : value for parameter, value in zip(names, parameters)}
+
+        if full_output:
+            info = {"solver" : "cholesky", 
+                    "condition_number" : condition_number,
+                    "chi_squared" : square_sum - np.dot(list(parameters.values()), normal_vector),
+                    "degrees_of_freedom" : self.n_observations + len(get_constraint_rows(names, custom_dict)[1]) - len(names)}
+            return parameters, uncertainties, info
+
+        return parameters, uncertainties
+
+    def compare_models(self, custom_dict: dict = None):
+        """Solves the 7, 8 and 9 parameter models from the accumulated normal equations, see compare_models"""
+        models = {}
+        for type in ["7", "8", "9"]:
+            parameters, uncertainties, info = self.solve(type, custom_dict, full_output = True)
+            k = self.n_observations - info["degrees_of_freedom"]
+            if self.weighted:
+                aic = info["chi_squared"] + 2 * k
+            else:
+                aic = self.n_observations * np.log(info["chi_squared"] / self.n_observations) + 2 * k
+            models[type] = {"parameters" : parameters, 
+                            "uncertainties" : uncertainties, 
+                            "chi_squared" : info["chi_squared"], 
+                            "degrees_of_freedom" : info["degrees_of_freedom"],
+                            "aic" : aic}
+
+        #F-tests of each model against the larger ones nesting it
+        tests = {}
+        for reduced, full in [("7", "8"), ("8", "9"), ("7", "9")]:
+            tests[reduced + "-" + full] = f_test(models[reduced]["chi_squared"], models[reduced]["degrees_of_freedom"], 
+                                                 models[full]["chi_squared"], models[full]["degrees_of_freedom"])
+
+        return models, tests
@@ -45,6 +45,7 @@ class InterfaceState:
             self.from_epoch = tk.DoubleVar(master, value = 2000)
             self.weighted = tk.BooleanVar(master, value = False)
             self.type = tk.StringVar(master, value = "7")
+            self.live = tk.BooleanVar(master, value = False)
     
             self.chi_squared = tk.DoubleVar()
             self.weighted_root_mean_squared = tk.DoubleVar()
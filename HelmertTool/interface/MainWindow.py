@@ -1,5 +1,6 @@
 import tkinter as tk 
 import tkinter.ttk as ttk
+import tkinter.messagebox
 import pandas as pd 
 import numpy as np 
 import sys 
@@ -8,18 +9,20 @@ from .FileSelecter import FileSelecter
 from .ParameterView import ParameterView
 from .Plot import Plot
 from .SelectStations import SelectStationsWindow 
+from .Tasks import TaskRunner
 
 from .InterfaceState import InterfaceState
-from ..io import load_sta
+from ..pipeline import Pipeline
 
-from ..visualise import plot_residuals
+from ..visualise import ResidualPlot
 from ..calc import *
 
 
 class MainWindow(tk.Tk):
     """Main application class for the helmert transfrom interface"""
 
-    file_formats = [".sta", ".ssc"]
+    file_formats = [".sta", ".ssc", ".snx"]
+    live_delay = 300
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -31,8 +34,15 @@ class MainWindow(tk.Tk):
         #Data
         self.df_from = None
         self.df_to = None
+        self.loaded = {"frame_from" : None, "frame_to" : None}
+        self.matched_from = None
+        self.matched_to = None
+        self.station_match = None
         self.stations = None
+        self.pipeline = Pipeline()
         self.transformed = None 
+        self.dirty = set()
+        self.live_id = None
 
         self.state = InterfaceState(self)
 
@@ -55,6 +65,11 @@ class MainWindow(tk.Tk):
         self.calculate_button = ttk.Button(self.data_frame, text = "Calculate parameters", state = "disable")
         self.transform_button = ttk.Button(self.data_frame, text = "Plot residuals", state = "disable")
         self.reset_button = ttk.Button(self.data_frame, text = "Reset parameters")
+        self.live_button_label = ttk.Label(self.data_frame, text="Live")
+        self.live_button = ttk.Checkbutton(self.data_frame, variable=self.state.transform.live, onvalue=True, offvalue=False)
+        self.status_var = tk.StringVar(self, value = "Ready")
+        self.status_label = ttk.Label(self.data_frame, textvariable = self.status_var)
+        self.progress_bar = ttk.Progressbar(self.data_frame, orient = "horizontal", length = 120)
         #self.line2 = ttk.Separator(self, orient = "horizontal")
 
         self.parameter_frame = tk.Frame(self)
@@ -71,6 +86,7 @@ class MainWindow(tk.Tk):
         self.plot = Plot(self.plot_frame, 2, 1)        
         #self.plot.fig.subplots_adjust(left=0.1, right=0.9, bottom=0.1, top=0.9, wspace=0.1, hspace=0.1)
         self.plot.fig.tight_layout(pad=1)
+        self.residual_plot = ResidualPlot(self.plot.axes[0], self.plot.axes[1])
 
         #Place Tkinter widgets
 
@@ -100,6 +116,10 @@ class MainWindow(tk.Tk):
         self.calculate_button.grid(row=6, column=2, sticky="w")
         self.transform_button.grid(row=6, column=3, sticky="ew")
         self.reset_button.grid(row=6, column=4, sticky="e")
+        self.live_button_label.grid(row=5, column=5)
+        self.live_button.grid(row=6, column=5)
+        self.progress_bar.grid(row=7, column=0, sticky="w", pady=5)
+        self.status_label.grid(row=7, column=1, columnspan=4, sticky="w")
         #self.line2.grid(row=8, column=0, sticky="ew")
 
         self.parameter_frame.grid(row=2, column=0, padx=30, pady=50, sticky="news")
@@ -115,6 +135,9 @@ class MainWindow(tk.Tk):
         self.plot.pack(expand=True, fill='both')
         self.update_plot()
         
+        #Background tasks
+        self.tasks = TaskRunner(self, progress_bar = self.progress_bar, status_var = self.status_var)
+
         #Bind actions
         self.state.transform.from_file_path.trace_add("write", self.df_from_change)
         self.state.transform.to_file_path.trace_add("write", self.df_to_change)
@@ -123,45 +146,87 @@ class MainWindow(tk.Tk):
         self.state.transform.type.trace_add("write", self.parameter_view.scale_type_change)
 
         self.calculate_button.config(command = self.calculate_parameters)
+        for is_custom in self.state.parameters.is_custom.values():
+            is_custom.trace_add("write", self.custom_change)
         self.transform_button.config(command = self.update_transform)
         self.reset_button.config(command = self.reset_parameters)
         self.export_button.config(command = self.export_data)
 
+        #Live mode
+        for name, value in self.state.parameters.values.items():
+            value.trace_add("write", lambda *args, name=name: self.value_change(name))
+        self.state.transform.weighted.trace_add("write", lambda *args: self.schedule("solve"))
+        self.state.transform.type.trace_add("write", lambda *args: self.schedule("solve"))
+        self.state.transform.live.trace_add("write", lambda *args: self.schedule("solve"))
+
     def select_stations(self, *args):
         """Open station selection window"""
         self.select_stations_window = SelectStationsWindow(self)
 
     def df_from_change(self, *args):
-        """Called on from_file change."""
-        if not self.state.transform.from_file_path.get()=="":
-            self.df_from = load_sta(self.state.transform.from_file_path.get())
-            self.set_stations()
+        """Called on from_file change, loads the frame in the background."""
+        path = self.state.transform.from_file_path.get()
+        if not path=="":
+            self.clear_stations()
+            self.pipeline.set(frame_from = path)
+            self.tasks.submit("load_from", self.pipeline.get, "load_from", self.pipeline.snapshot(), callback = lambda df: self.set_df_from(path, df), 
+                              error_callback = self.show_error, description = "Loading frame 1")
 
     def df_to_change(self, *args):
-        """Called on to_file change."""
-        if not self.state.transform.to_file_path.get()=="":
-            self.df_to = load_sta(self.state.transform.to_file_path.get())
-            self.set_stations()
+        """Called on to_file change, loads the frame in the background."""
+        path = self.state.transform.to_file_path.get()
+        if not path=="":
+            self.clear_stations()
+            self.pipeline.set(frame_to = path)
+            self.tasks.submit("load_to", self.pipeline.get, "load_to", self.pipeline.snapshot(), callback = lambda df: self.set_df_to(path, df), 
+                              error_callback = self.show_error, description = "Loading frame 2")
+
+    def set_df_from(self, path, df):
+        self.df_from = df
+        self.loaded["frame_from"] = path
+        self.set_stations()
+
+    def set_df_to(self, path, df):
+        self.df_to = df
+        self.loaded["frame_to"] = path
+        self.set_stations()
+
+    def show_error(self, error):
+        tk.messagebox.showerror("Helmert Tool", str(error))
+
+    def clear_stations(self):
+        """Drops the station list of the previous frames, fits and exports wait for the next set_match"""
+        self.stations = None
+        self.pipeline.set(selection = None)
+        for key in ["match", "fit", "transform"]:
+            self.tasks.cancel(key)
+        for button in [self.select_stations_button, self.transform_button, self.calculate_button, self.export_button]:
+            button.config(state = "disable")
 
     def set_stations(self):
+        """Matches the loaded frames in the background once the loads of both current input files have been delivered"""
+        if all(not self.loaded[name] is None and self.loaded[name] == self.pipeline.inputs[name] for name in self.loaded):
+            self.clear_stations()
+            self.tasks.submit("match", self.pipeline.get, "match", self.pipeline.snapshot(), callback = self.set_match, 
+                              error_callback = self.show_error, description = "Matching stations")
+
+    def set_match(self, match):
         """Updates the station list as the intersection of stations"""
-        if not self.df_from is None and not self.df_to is None:
-            station_intersection = self.df_from.Station_Name.isin(self.df_to.Station_Name)
-            df_from = self.df_from[station_intersection]
-            df_to = self.df_to[station_intersection]
-            station_intersection.index = df_to.index
+        df_from, df_to, self.station_match = match
+        self.matched_from, self.matched_to = df_from, df_to
 
-            sigmas = np.sqrt(df_from.X_sigma**2 + df_from.Y_sigma**2 + df_from.Z_sigma**2 + df_to.X_sigma**2 + df_to.Y_sigma**2 + df_to.Z_sigma**2) 
-            stations = df_from.Station_Name
+        sigmas = np.sqrt(df_from.X_sigma**2 + df_from.Y_sigma**2 + df_from.Z_sigma**2 + df_to.X_sigma**2 + df_to.Y_sigma**2 + df_to.Z_sigma**2) 
+        stations = df_from.Station_Name
 
-            self.stations = pd.DataFrame({"Station_Name" : stations, "Sigma" : sigmas, "Selected" : True})
-            self.select_stations_button.config(state = "normal")
-            self.transform_button.config(state = "normal")
-            self.calculate_button.config(state = "normal")
-            self.export_button.config(state = "normal")
+        self.stations = pd.DataFrame({"Station_Name" : stations, "Sigma" : sigmas, "Selected" : True, "Influence" : np.nan, 
+                                      "LAT" : df_from.LAT, "LONG" : df_from.LONG})
+        self.select_stations_button.config(state = "normal")
+        self.transform_button.config(state = "normal")
+        self.calculate_button.config(state = "normal")
+        self.export_button.config(state = "normal")
 
-    def calculate_parameters(self, *args):
-        
+    def get_custom_dict(self):
+        """Returns the custom parameter values set in the interface"""
         custom_dict = {}
         for name, parameter in self.state.parameters.get_parameter_dict().items():
             if parameter.is_custom.get():
@@ -169,13 +234,68 @@ class MainWindow(tk.Tk):
             else:
                 custom_dict[name] = None
 
-        weighted = self.state.transform.weighted.get()
-        type = self.state.transform.type.get()
+        return custom_dict
+
+    def update_inputs(self):
+        """Pass the station selection and fit settings of the interface to the pipeline"""
+        self.pipeline.set(selection = self.stations.Selected.to_numpy(), weighted = self.state.transform.weighted.get(), 
+                          type = self.state.transform.type.get(), custom_dict = self.get_custom_dict())
+
+    def custom_change(self, *args):
+        """Re-solve from the cached normal equations when a parameter is fixed or freed"""
+        if self.state.transform.live.get():
+            self.schedule("solve")
+        elif not self.stations is None and not self.tasks.busy("fit"):
+            self.update_inputs()
+            if self.pipeline.cached("normal_equations"):
+                self.set_parameters(*self.pipeline.get("solve"))
+
+    def value_change(self, name):
+        """A custom value changes the fit, other values only the transform"""
+        self.schedule("solve" if self.state.parameters.is_custom[name].get() else "transform")
+
+    def stations_change(self):
+        """Called by the station selection window when the selection changed"""
+        self.schedule("solve")
+
+    def schedule(self, stage: str):
+        """In live mode mark stage ("solve" or "transform") dirty and recompute once the inputs have been unchanged for live_delay ms"""
+        if not self.state.transform.live.get() or self.stations is None:
+            return
 
-        df_from = self.df_from[self.stations.Selected]
-        df_to = self.df_to[self.stations.Selected]
+        self.dirty.add(stage)
+        if not self.live_id is None:
+            self.after_cancel(self.live_id)
+        self.live_id = self.after(self.live_delay, self.recompute)
+
+    def recompute(self):
+        """Re-run the dirty stages, a new solve sets the parameter values which in turn schedules the transform, 
+        residuals, statistics and plot"""
+        self.live_id = None
+        dirty, self.dirty = self.dirty, set()
+        if self.stations is None:
+            return
 
-        value_dict, sigma_dict = calculate_parameters(df_from, df_to, weighted, type, custom_dict)
+        if "solve" in dirty:
+            self.tasks.cancel("transform")
+            self.calculate_parameters()
+        elif "transform" in dirty and not self.tasks.busy("fit"):
+            self.update_transform()
+
+    def calculate_parameters(self, *args):
+        """Fits the parameters in the background, the pipeline reuses the normal equations if the selection and weighting are unchanged"""
+        self.update_inputs()
+        self.tasks.submit("fit", fit_frames, self.pipeline, self.pipeline.snapshot(), 
+                          callback = lambda result: self.set_fit(*result), error_callback = self.show_error, description = "Calculating parameters")
+
+    def set_fit(self, value_dict, sigma_dict, influence):
+        self.set_parameters(value_dict, sigma_dict)
+
+        #Influence (Cook's distance) of each selected station on the fit
+        self.stations["Influence"] = np.nan
+        self.stations.loc[influence.index, "Influence"] = influence
+
+    def set_parameters(self, value_dict, sigma_dict):
         for name, value in value_dict.items():
             self.state.parameters.values[name].set(value)
 
@@ -183,28 +303,21 @@ class MainWindow(tk.Tk):
             self.state.parameters.sigmas[name].set(value)
 
     def update_transform(self, *args):
-        self.calculate_transform()
-        self.update_plot()
-        self.update_statistics()
+        """Transforms and decomposes the residuals in the background, then plots them"""
+        self.update_inputs()
+        self.pipeline.set(parameters = {name : var.get() for name, var in self.state.parameters.values.items()})
 
-    def calculate_transform(self, *args):
-        parameter_dict = {name : var.get() for name, var in self.state.parameters.values.items()}
-        
-        df_from = self.df_from[self.stations.Selected]
-        df_to = self.df_to[self.stations.Selected]
+        self.tasks.submit("transform", transform_frames, self.pipeline, self.pipeline.snapshot(), 
+                          callback = lambda result: self.set_transform(*result), error_callback = self.show_error, description = "Transforming")
 
-        self.transformed = helmert_transform(df_from, parameter_dict)
-        self.transformed = calculate_residuals(self.transformed, df_to)
-        self.transformed = decompose_residuals(self.transformed)
+    def set_transform(self, transformed, statistics):
+        self.transformed = transformed
+        self.update_plot()
+        self.update_statistics(*statistics)
 
     def update_plot(self, *args):
-        self.plot.clear()
-        if not self.transformed is None:
-            transformed = self.transformed#[self.stations.Selected]
-        else:
-            transformed = None
-        plot_residuals(transformed, self.plot.axes[0], self.plot.axes[1])
-        self.plot.draw()
+        """Update the residual arrows in place, see visualise.ResidualPlot"""
+        self.residual_plot.update(self.transformed)
 
     def export_data(self, *args):
         f = tk.filedialog.asksaveasfile(mode='w', defaultextension=".txt")
@@ -222,8 +335,8 @@ class MainWindow(tk.Tk):
         sigmas = [var.get() for var in self.state.parameters.sigmas.values()]
         parameter_df = pd.DataFrame({"transformation" : transformation, "values" : values, "sigmas" : sigmas})
 
-        frame_df = self.df_from.merge(self.df_to, left_index=True, right_index=True, suffixes=("_Frame1", "_Frame2"))
-        frame_df = frame_df.drop(columns = ["Station_Name_Frame1", "Date_Frame1", "Station_Name_Frame2", "Date_Frame2", "LAT_Frame2", "LONG_Frame2", ])
+        frame_df = self.matched_from.merge(self.matched_to, left_index=True, right_index=True, suffixes=("_Frame1", "_Frame2"))
+        frame_df = frame_df.drop(columns = ["Station_Name_Frame1", "Date_Frame1", "Station_Name_Frame2", "Date_Frame2", "LAT_Frame2", "LONG_Frame2", ], errors = "ignore")
         if not self.transformed is None:
             frame_df = frame_df.merge(self.transformed, left_index=True, right_index=True, suffixes=("", "_Transformed"))
 
@@ -240,16 +353,10 @@ End Frame
 
         return string
 
-    def update_statistics(self):
-        df_from = self.df_from[self.stations.Selected]
-        df_to = self.df_to[self.stations.Selected]
-        
-        weighted_sum = sum(self.transformed.dX ** 2 / (df_from.X_sigma**2 + df_to.X_sigma**2) + self.transformed.dY ** 2 / (df_from.Y_sigma**2 + df_to.Y_sigma**2) + self.transformed.dZ ** 2 / (df_from.Z_sigma**2 + df_to.Z_sigma**2))
-        normalize_constant = sum(1 / (df_from.X_sigma**2 + df_to.X_sigma**2) + 1 / (df_from.Y_sigma**2 + df_to.Y_sigma**2) + 1 / (df_from.Z_sigma**2 + df_to.Z_sigma**2))
-        
-        deg_of_freedom = 3*len(df_from.index) - float(self.state.transform.type.get())
-        self.state.transform.chi_squared.set(self.value_to_string(weighted_sum/deg_of_freedom))
-        self.state.transform.weighted_root_mean_squared.set(self.value_to_string(weighted_sum/normalize_constant))
+    def update_statistics(self, chi_squared, weighted_root_mean_squared):
+        """Show the statistics of the transform, see pipeline.statistics"""
+        self.state.transform.chi_squared.set(self.value_to_string(chi_squared))
+        self.state.transform.weighted_root_mean_squared.set(self.value_to_string(weighted_root_mean_squared))
 
     def reset_parameters(self, *args):
         """Reset all parameter values to zero"""
@@ -266,4 +373,16 @@ End Frame
         return string     
 
     def exit(self):
-        sys.exit(0)
\ No newline at end of file
+        if not self.live_id is None:
+            self.after_cancel(self.live_id)
+        self.tasks.shutdown()
+        sys.exit(0)
+
+def fit_frames(pipeline, inputs):
+    """Background part of MainWindow.calculate_parameters, returns the parameters, uncertainties and station influence"""
+    value_dict, sigma_dict = pipeline.get("solve", inputs)
+    return value_dict, sigma_dict, pipeline.get("influence", inputs)
+
+def transform_frames(pipeline, inputs):
+    """Background part of MainWindow.update_transform, returns the transformed frame with decomposed residuals and the statistics"""
+    return pipeline.get("enu", inputs), pipeline.get("statistics", inputs)
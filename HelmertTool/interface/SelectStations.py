@@ -1,138 +1,187 @@
-import tkinter as tk 
-import pandas as pd 
-import tkinter.ttk as ttk 
+import tkinter as tk
+import pandas as pd
+import numpy as np
+import fnmatch
+import tkinter.ttk as ttk
 from HelmertTool.io import get_path
-class SelectStationsWindow(tk.Tk):
-    
+
+class SelectStationsWindow(tk.Toplevel):
+    """Station selection table backed directly by the stations dataframe of the master.
+
+    The table is virtualized, only a window of rows is kept in the treeview and filled from the current sort order of
+    the dataframe on scrolling, so opening and sorting is instant also for thousands of stations. Stations are toggled
+    by clicking a row, or selected and deselected in bulk by a name pattern, a sigma threshold and a LAT/LONG region."""
+
+    visible_rows = 30
+    columns = {"Selected" : ("Select", 50), "Station_Name" : ("Station name", 120), "Sigma" : ("Sigma", 70), "Influence" : ("Influence", 70)}
+
     def __init__(self, master, *args, **kwargs):
-        super().__init__()
+        super().__init__(master, *args, **kwargs)
         self.master = master
         self.stations = master.stations
         self.resizable(height=False, width=False)
         self.title("Select stations")
-        
-        self.init_rows_and_header_frame()
-        self.rows = {}
+
+        self.order = np.arange(len(self.stations.index))
+        self.offset = 0
+        self.sort_column = None
+        self.ascending = True
         self.use_default_stations = True
         self.default_stations = self.load_default_stations()
 
-        for station in self.stations.itertuples():
-            row = SelectStationsRow(self.rows_frame, station, self.set_selection)            
-            self.rows[station.Index] = row
-        
-        self.header_frame.columnconfigure(0, minsize=70)
-        self.header_frame.columnconfigure(1, minsize=100)
-        self.header_frame.columnconfigure(2, minsize=30)
-
-        self.rows_frame.columnconfigure(0, minsize=70)
-        self.rows_frame.columnconfigure(1, minsize=100)
-        self.rows_frame.columnconfigure(2, minsize=30)
-
-
-        tk.Label(self.header_frame, text = "Select stations",font=("helvetica", 12)).grid(row=0, column=0, columnspan=2, pady=5, padx=5)
-        ttk.Button(self.header_frame, text = "Default", command = self.toggle_default_stations).grid(row=0, column=2)
-        ttk.Label(self.header_frame, text = "Select").grid(row=1, column=0, pady=5)
-        ttk.Button(self.header_frame, text = "Station name", command = self.sort_by_name).grid(row=1, column=1)
-        ttk.Button(self.header_frame, text = "Sigma", command = self.sort_by_sigma).grid(row=1, column=2)
-        self.grid()
+        self.init_table()
+        self.init_filters()
+        self.render()
 
-        self.bind_all("<Up>", self.scroll_up)
-        self.bind_all("<Down>", self.scroll_down)
+        self.bind("<Up>", self.scroll_up)
+        self.bind("<Down>", self.scroll_down)
         self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.grab_set()
 
+    def init_table(self):
+        table_frame = tk.Frame(self)
+        table_frame.grid(row=1, column=0, sticky="news", padx=5)
+
+        header_frame = tk.Frame(self)
+        header_frame.grid(row=0, column=0, sticky="ew", padx=5)
+        tk.Label(header_frame, text = "Select stations",font=("helvetica", 12)).grid(row=0, column=0, pady=5, padx=5)
+        ttk.Button(header_frame, text = "Default", command = self.toggle_default_stations).grid(row=0, column=1)
+        self.count_var = tk.StringVar(self, value = "")
+        ttk.Label(header_frame, textvariable = self.count_var).grid(row=0, column=2, padx=10)
+
+        self.table = ttk.Treeview(table_frame, columns = list(self.columns), show = "headings", height = self.visible_rows, selectmode = "none")
+        for column, (text, width) in self.columns.items():
+            self.table.heading(column, text = text, command = lambda column=column: self.sort_by(column))
+            self.table.column(column, width = width, anchor = "w")
+        for row in range(self.visible_rows):
+            self.table.insert("", "end", iid = str(row), values = ["", "", "", ""])
+
+        self.yscrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=self.yview)
+        self.table.grid(row=0, column=0, sticky="news")
+        self.yscrollbar.grid(row=0, column=1, sticky="ns")
+
+        self.table.bind("<Button-1>", self.toggle_row)
+        self.table.bind("<MouseWheel>", lambda event: self.scroll(-int(np.sign(event.delta)) * 3))
+        self.table.bind("<Button-4>", lambda event: self.scroll(-3))
+        self.table.bind("<Button-5>", lambda event: self.scroll(3))
+
+    def init_filters(self):
+        filter_frame = ttk.LabelFrame(self, text = "Filter")
+        filter_frame.grid(row=2, column=0, sticky="ew", padx=5, pady=5)
+
+        self.name_pattern = tk.StringVar(self, value = "*")
+        self.max_sigma = tk.StringVar(self, value = "")
+        self.region = {name : tk.StringVar(self, value = "") for name in ["LAT_min", "LAT_max", "LONG_min", "LONG_max"]}
+
+        ttk.Label(filter_frame, text = "Name").grid(row=0, column=0, sticky="w")
+        ttk.Entry(filter_frame, textvariable = self.name_pattern, width = 12).grid(row=0, column=1, sticky="w")
+        ttk.Label(filter_frame, text = "Sigma <=").grid(row=0, column=2, sticky="w")
+        ttk.Entry(filter_frame, textvariable = self.max_sigma, width = 8).grid(row=0, column=3, sticky="w")
+        for i, (name, var) in enumerate(self.region.items()):
+            ttk.Label(filter_frame, text = name.replace("_", " ")).grid(row=1 + i//2, column=2*(i%2), sticky="w")
+            ttk.Entry(filter_frame, textvariable = var, width = 8).grid(row=1 + i//2, column=1 + 2*(i%2), sticky="w")
+
+        ttk.Button(filter_frame, text = "Select", command = lambda: self.set_filtered(True)).grid(row=3, column=0, columnspan=2, pady=5)
+        ttk.Button(filter_frame, text = "Deselect", command = lambda: self.set_filtered(False)).grid(row=3, column=2, columnspan=2, pady=5)
+
+    def get_filter(self):
+        """Returns a boolean mask of the stations matching the name pattern, sigma threshold and region, empty fields match all"""
+        mask = np.ones(len(self.stations.index), dtype=bool)
+
+        pattern = self.name_pattern.get().strip()
+        if pattern:
+            mask &= self.stations.Station_Name.astype(str).str.match(fnmatch.translate(pattern), case=False).to_numpy()
+
+        bounds = {"Sigma_max" : self.max_sigma, **self.region}
+        for name, var in bounds.items():
+            column, bound = name.rsplit("_", 1)
+            try:
+                value = float(var.get())
+            except ValueError:
+                continue
+            if column in self.stations:
+                values = self.stations[column].to_numpy()
+                mask &= values >= value if bound == "min" else values <= value
+
+        return mask
+
+    def set_filtered(self, value: bool):
+        """Select or deselect all stations matching the filter"""
+        self.stations.loc[self.get_filter(), "Selected"] = value
+        self.render()
+        self.master.stations_change()
+
+    def sort_by(self, column):
+        """Sort the table by column, again by the same column to reverse the order"""
+        self.ascending = not self.ascending if column == self.sort_column else True
+        self.sort_column = column
+
+        values = self.stations[column]
+        values = values if pd.api.types.is_numeric_dtype(values) else values.astype(str).str.lower()
+        order = np.argsort(values.to_numpy(), kind="stable")
+        if not self.ascending:
+            order = order[::-1]
+        self.order = order
+        self.render()
+
+    def render(self):
+        """Fill the visible rows of the table from the stations at the current scroll offset"""
+        n = len(self.order)
+        self.offset = max(0, min(self.offset, n - self.visible_rows))
+        rows = self.stations.iloc[self.order[self.offset:self.offset + self.visible_rows]]
+
+        for row, station in enumerate(rows.itertuples()):
+            influence = "-" if pd.isna(station.Influence) else round(station.Influence, 3)
+            self.table.item(str(row), values = ["☑" if station.Selected else "☐", station.Station_Name, round(station.Sigma, 3), influence])
+        for row in range(len(rows.index), self.visible_rows):
+            self.table.item(str(row), values = ["", "", "", ""])
+
+        if n > 0:
+            self.yscrollbar.set(self.offset / n, min(1, (self.offset + self.visible_rows) / n))
+        self.count_var.set(f"{int(self.stations.Selected.sum())} of {n} selected")
+
+    def yview(self, *args):
+        """Scrollbar command"""
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.order))
+            self.render()
+        elif args[0] == "scroll":
+            self.scroll(int(args[1]) * (self.visible_rows if args[2] == "pages" else 1))
+
+    def scroll(self, rows: int):
+        self.offset += rows
+        self.render()
+
     def scroll_up(self, *args):
-        self.canvas.yview_scroll(-5, "units")
+        self.scroll(-5)
 
     def scroll_down(self, *args):
-        self.canvas.yview_scroll(5, "units")
-    
+        self.scroll(5)
+
+    def toggle_row(self, event):
+        """Toggle the selection of the clicked station"""
+        if self.table.identify_region(event.x, event.y) != "cell":
+            return
+        row = self.table.identify_row(event.y)
+        position = self.offset + int(row)
+        if row and position < len(self.order):
+            index = self.stations.index[self.order[position]]
+            self.stations.at[index, "Selected"] = not self.stations.at[index, "Selected"]
+            self.render()
+            self.master.stations_change()
+
     def on_close(self):
-        #self.master.new_helmert_transform()
         self.destroy()
 
-    def grid(self):
-        for row_index, station_index in enumerate(self.stations.index):  
-            self.rows[station_index].grid(row_index)
-
-    def set_selection(self, index, value):
-        self.stations.at[index, "Selected"] = value
-
-    def sort_by_name(self):
-        self.stations = self.stations.sort_values(by="Station_Name")
-        #self.master.stations = self.stations
-        self.grid()
-
-    def sort_by_sigma(self):
-        self.stations = self.stations.sort_values(by="Sigma")
-        #self.master.stations = self.stations
-        self.grid()
-
-    def init_rows_and_header_frame(self):
-        header_canvas = tk.Canvas(self, highlightthickness=0, height=65, width=250) #!Hardcoded height
-        header_canvas.grid(row=0, column=0, sticky="news")
-        self.canvas = tk.Canvas(self, highlightthickness=0, height=700, width=250)
-        self.canvas.grid(row=1, column=0, sticky="news")
-
-        def xview(*args):
-            self.canvas.xview(*args)
-            header_canvas.xview(*args)
-
-        self.yscrollbar = tk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
-        self.yscrollbar.grid(row=1, column=1, sticky = "ns")
-        self.xscrollbar = tk.Scrollbar(self, orient="horizontal", command=xview)
-        self.xscrollbar.grid(row=2, column=0, sticky = "we")
-
-        self.canvas.configure(yscrollcommand=self.yscrollbar.set, xscrollcommand=self.xscrollbar.set)
-        header_canvas.configure(xscrollcommand=self.xscrollbar.set)
-
-        self.rows_frame = tk.Frame(self.canvas)
-        self.header_frame = tk.Frame(header_canvas)
-        self.canvas.create_window((0, 0), window=self.rows_frame, anchor="nw")   
-        header_canvas.create_window((0, 0), window=self.header_frame, anchor="nw")
-        
-        def scroll_config(*args):
-            """Sets scroll region for table and header"""
-            region = (0,0, header_canvas.bbox("all")[2], self.canvas.bbox("all")[3])
-            self.canvas.configure(scrollregion=region)
-            header_canvas.configure(scrollregion=header_canvas.bbox("all"))
-
-        self.rows_frame.bind("<Configure>", scroll_config)
-        self.header_frame.bind("<Configure>", scroll_config)
-
     def toggle_default_stations(self, *args):
-        
         if self.use_default_stations:
-            for row in self.rows.values():
-                row.var.set(row.station.Station_Name in self.default_stations.values)
+            self.stations["Selected"] = self.stations.Station_Name.isin(self.default_stations[0])
             self.use_default_stations = False
         else:
-            for row in self.rows.values():
-                row.var.set(True)
+            self.stations["Selected"] = True
             self.use_default_stations = True
+        self.render()
+        self.master.stations_change()
 
     def load_default_stations(self):
         return pd.read_fwf(get_path("transform_sites.txt"), header = None)
-
-class SelectStationsRow():
-
-    def __init__(self, master, station, set_selection, *args, **kwargs):
-
-        self.master = master 
-        self.set_selection = set_selection
-        self.station = station
-
-        self.var = tk.BooleanVar(self.master, value = station.Selected)
-        self.var.trace("w", lambda *args: self.set_selection(station.Index, self.var.get()))
-
-        self.check = ttk.Checkbutton(self.master, variable=self.var, onvalue=True, offvalue=False)
-        self.station_name_label = tk.Label(self.master, text = station.Station_Name)
-        self.sigma_label = tk.Label(self.master, text = round(station.Sigma,3))
-   
-    def grid(self, row):
-        self.check.grid_forget()
-        self.check.grid(row=row, column=0, sticky="ew", padx=23)
-        self.station_name_label.grid_forget()
-        self.station_name_label.grid(row=row, column=1, sticky="w", padx=10)
-        self.sigma_label.grid_forget()
-        self.sigma_label.grid(row=row, column=2, sticky="w", padx=10)
@@ -0,0 +1,152 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+class Task:
+    """Handle of a background task, the running function may report progress and should stop early once cancelled"""
+
+    def __init__(self, key, runner, description: str = None):
+        self.key = key
+        self.runner = runner
+        self.description = description or str(key)
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """Cancel the task, a task that has not started yet is never run and the result of a running one is discarded"""
+        self.cancel_event.set()
+        if not self.future is None:
+            self.future.cancel()
+
+    def report(self, fraction: float = None, message: str = None):
+        """Report progress (a fraction from 0 to 1) from the worker thread, shown on the next poll of the runner"""
+        self.runner.results.put(("progress", self, (fraction, message)))
+
+class TaskRunner:
+    """Runs loading, fitting and transforming on a background thread pool and hands the results to callbacks on the Tk main loop.
+
+    Worker threads never touch Tk, results are passed through a queue polled with after. Submitting a task cancels the
+    previous task with the same key, so results of outdated inputs are never delivered. Threads rather than processes
+    are used as the dataframes passed around are large and numpy and the file parsers release the GIL for the heavy work."""
+
+    poll_interval = 50
+
+    def __init__(self, master, max_workers: int = 2, progress_bar: ttk.Progressbar = None, status_var: tk.StringVar = None):
+        self.master = master
+        self.executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "HelmertTool")
+        self.results = queue.Queue()
+        self.tasks = {}
+        self.callbacks = {}
+        self.progress_bar = progress_bar
+        self.status_var = status_var
+        self.indeterminate = False
+
+        self.poll_id = self.master.after(self.poll_interval, self.poll)
+
+    def submit(self, key, function, *args, callback = None, error_callback = None, report_progress: bool = False, description: str = None, **kwargs):
+        """Run function(*args, **kwargs) in the background and call callback(result) on the main loop when done.
+
+        With report_progress the function is passed the Task as task keyword, to call task.report and check
+        task.cancelled. Exceptions are passed to error_callback, or raised on the main loop if there is none."""
+        self.cancel(key)
+
+        task = Task(key, self, description)
+        if report_progress:
+            kwargs["task"] = task
+        self.tasks[key] = task
+        self.callbacks[task] = (callback, error_callback)
+        task.future = self.executor.submit(self.run, task, function, args, kwargs)
+        self.update_status()
+
+        return task
+
+    def run(self, task: Task, function, args, kwargs):
+        """Worker side of a task"""
+        if task.cancelled:
+            return
+        try:
+            result = function(*args, **kwargs)
+        except Exception as error:
+            self.results.put(("error", task, error))
+        else:
+            self.results.put(("done", task, result))
+
+    def poll(self):
+        """Deliver finished results and progress reports on the main loop"""
+        self.poll_id = self.master.after(self.poll_interval, self.poll)
+        while True:
+            try:
+                kind, task, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+
+            current = self.tasks.get(task.key) is task and not task.cancelled
+            if kind == "progress":
+                if current:
+                    self.show_progress(task, *value)
+                continue
+
+            callback, error_callback = self.callbacks.pop(task, (None, None))
+            if not current:
+                continue
+            del self.tasks[task.key]
+            self.update_status()
+
+            if kind == "error":
+                if error_callback is None:
+                    raise value
+                error_callback(value)
+            elif not callback is None:
+                callback(value)
+
+    def cancel(self, key = None):
+        """Cancel the task with key, or all tasks if key is None"""
+        for task_key in list(self.tasks) if key is None else [key]:
+            task = self.tasks.pop(task_key, None)
+            if not task is None:
+                task.cancel()
+                self.callbacks.pop(task, None)
+        self.update_status()
+
+    def busy(self, key = None):
+        """Check if the task with key, or any task if key is None, is pending"""
+        return bool(self.tasks) if key is None else key in self.tasks
+
+    def show_progress(self, task: Task, fraction: float = None, message: str = None):
+        if not self.progress_bar is None and not fraction is None:
+            self.stop_indeterminate()
+            self.progress_bar.config(mode = "determinate", value = 100 * fraction)
+        if not self.status_var is None and not message is None:
+            self.status_var.set(message)
+
+    def update_status(self):
+        """Show the pending tasks in the status var and animate the progress bar while busy"""
+        if not self.status_var is None:
+            self.status_var.set(", ".join(task.description for task in self.tasks.values()) + "..." if self.tasks else "Ready")
+
+        if self.progress_bar is None:
+            return
+        if self.tasks and not self.indeterminate:
+            self.progress_bar.config(mode = "indeterminate")
+            self.progress_bar.start(self.poll_interval)
+            self.indeterminate = True
+        elif not self.tasks:
+            self.stop_indeterminate()
+            self.progress_bar.config(mode = "determinate", value = 0)
+
+    def stop_indeterminate(self):
+        if self.indeterminate:
+            self.progress_bar.stop()
+            self.indeterminate = False
+
+    def shutdown(self):
+        """Cancel all tasks and stop the worker threads and polling"""
+        self.cancel()
+        self.master.after_cancel(self.poll_id)
+        self.executor.shutdown(wait = False, cancel_futures = True)
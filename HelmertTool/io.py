@@ -1,9 +1,30 @@
 import pandas as pd 
 import numpy as np
 import os 
+import json
+import hashlib
+import zipfile
+import re
+import tempfile
+from collections import namedtuple
 
-def load_sta(fpath: str, epoch: float = 0):
-    """Load a .sta TRF file to a pandas dataframe"""
+#On disk cache of parsed frames, configurable through the environment
+cache_directory = os.environ.get("HELMERTTOOL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "HelmertTool"))
+cache_max_bytes = int(os.environ.get("HELMERTTOOL_CACHE_MAX_BYTES", 512 * 2**20))
+cache_version = 4
+
+#Semi major axis and flattening of reference ellipsoids
+ellipsoids = {"GRS80" : (6378137.0, 1/298.257222101), "WGS84" : (6378137.0, 1/298.257223563)}
+
+def load_sta(fpath: str, epoch: float = None, cache: bool = True):
+    """Load a .sta TRF file to a pandas dataframe, cached on disk unless cache is False. 
+    
+    .sta files hold no velocities, so giving an epoch to propagate to raises a ValueError."""
+    df = load_cached(parse_sta, fpath, cache)
+    return propagate_epoch(df, epoch) if epoch else df
+
+def parse_sta(fpath: str):
+    """Parse a .sta TRF file to a pandas dataframe"""
 
     column_names = ["Value_Type", "Station_Name", "Date", "X", "X_sigma", "Y", "Y_sigma", "Z", "Z_sigma", ]
     column_specs = [(0,7), (10, 19), (19,25), (31,45), (52, 59), (65,79), (87,93), (99,113), (120,127)]
@@ -19,15 +40,114 @@ def load_sta(fpath: str, epoch: float = 0):
     df[["X_sigma", "Y_sigma", "Z_sigma"]] = df[["X_sigma", "Y_sigma", "Z_sigma"]].astype(np.float64)*10**-3
 
     df = df.drop(columns="Value_Type")
+    df["Epoch"] = df["Date"]
     
     df = calculate_long_lat(df)
     return df
 
-def load_ssc(fpath: str):
-    """Load a .ssc TRF file to a pandas dataframe"""
+def load_ssc(fpath: str, epoch: float = None, cache: bool = True):
+    """Load a .ssc TRF file to a pandas dataframe, cached on disk unless cache is False, with positions propagated to epoch if given"""
+    df = load_cached(parse_ssc, fpath, cache)
+    return propagate_epoch(df, epoch) if epoch else df
+
+#Fixed width layouts of the ITRF SSC position lines, velocity lines share the numeric columns
+ssc_formats = {"2008" : {"Domes" : (0, 9), "Station_Name" : (9, 25), "Tech" : (25, 31), "Code" : (31, 36), 
+                         "X" : (36, 49), "Y" : (49, 62), "Z" : (62, 75), "X_sigma" : (75, 81), "Y_sigma" : (81, 87), "Z_sigma" : (87, 93), 
+                         "Soln" : (95, 96)},
+               "2014" : {"Domes" : (0, 9), "Station_Name" : (9, 25), "Tech" : (25, 31), "Code" : (31, 36), 
+                         "X" : (36, 50), "Y" : (50, 64), "Z" : (64, 78), "X_sigma" : (78, 85), "Y_sigma" : (85, 92), "Z_sigma" : (92, 99), 
+                         "Soln" : (100, 102)}}
+
+#Reference epochs of the ITRF realisations, used if the SSC header does not state it
+ssc_epochs = {"2008" : 2005.0, "2014" : 2010.0}
+
+def parse_ssc(fpath: str):
+    """Parse a .ssc TRF file to a pandas dataframe in a single pass.
+
+    The file is read once into a fixed width character array, station lines are classified as position lines (with a 
+    station name) or velocity lines (without) and every field is converted column wise. Each velocity line is paired 
+    with the position line above it. The layout is detected from the file header, see detect_ssc_format."""
+    with open(fpath, "rb") as f:
+        lines = f.read().splitlines()
+
+    is_data = [len(line) > 9 and line[:5].isdigit() and line[5:6] in (b"S", b"M") for line in lines]
+    header = [line for line, data in zip(lines, is_data) if not data]
+    lines = [line for line, data in zip(lines, is_data) if data]
+    ssc_format = detect_ssc_format(header, lines)
+    column_specs = ssc_formats[ssc_format]
+
+    width = max(end for _, end in column_specs.values())
+    characters = np.frombuffer(b"".join(line[:width].ljust(width) for line in lines), dtype=np.uint8).reshape(-1, width)
+
+    def field(name, rows = slice(None)):
+        start, end = column_specs[name]
+        return np.ascontiguousarray(characters[rows, start:end])
+
+    def is_blank(name, rows = slice(None)):
+        return np.all(field(name, rows) == ord(" "), axis=1)
+
+    def text(name, rows):
+        values = field(name, rows).view(f"S{np.diff(column_specs[name])[0]}")[:, 0]
+        return np.char.strip(np.char.decode(values, "latin-1"))
+
+    def number(name, rows):
+        values = field(name, rows).view(f"S{np.diff(column_specs[name])[0]}")[:, 0]
+        return np.where(is_blank(name, rows), b"nan", values).astype(np.float64)
+
+    #Pair velocity lines with the preceding position line of the same station and solution
+    is_position = ~is_blank("Station_Name")
+    velocity = np.flatnonzero(~is_position[1:] & is_position[:-1]) + 1
+    position = velocity - 1
+    velocity_soln, position_soln = number("Soln", velocity), number("Soln", position)
+    is_pair = np.all(field("Domes", velocity) == field("Domes", position), axis=1) & (np.isnan(velocity_soln) | (velocity_soln == position_soln))
+    velocity, position, position_soln = velocity[is_pair], position[is_pair], position_soln[is_pair]
+
+    df = pd.DataFrame({name : text(name, position) for name in ["Domes", "Station_Name", "Tech", "Code"]})
+    for name in ["X", "Y", "Z", "X_sigma", "Y_sigma", "Z_sigma"]:
+        df[name] = number(name, position)
+    df["Soln"] = np.where(np.isnan(position_soln), 1, position_soln)
+    for name in ["X", "Y", "Z", "X_sigma", "Y_sigma", "Z_sigma"]:
+        df[name.replace("_", "_v_") if "_" in name else name + "_v"] = number(name, velocity)
+
+    #Drop stations with incomplete positions
+    is_complete = df[["X", "Y", "Z", "X_sigma", "Y_sigma", "Z_sigma"]].notna().all(axis=1) & (df[["Domes", "Station_Name", "Tech", "Code"]] != "").all(axis=1)
+    df = df[is_complete].reset_index(drop=True)
+    df["Epoch"] = detect_ssc_epoch(header, ssc_format)
+    df = calculate_long_lat(df)
+
+    return df
+
+def detect_ssc_epoch(header: list, ssc_format: str):
+    """Returns the reference epoch stated in an SSC header as "EPOCH 2010.0", else the epoch of the ITRF realisation"""
+    for line in header:
+        match = re.search(rb"EPOCH\s*:?\s*(\d{4}(\.\d*)?)", line.upper())
+        if match:
+            return float(match.group(1))
+
+    return ssc_epochs[ssc_format]
+
+def detect_ssc_format(header: list, lines: list):
+    """Returns the key in ssc_formats of an SSC file from the ITRF realisation named in its header, falling back on 
+    the position of the decimal point in the X coordinate of the first station"""
+    for line in header:
+        for year in ssc_formats:
+            if f"ITRF{year}".encode() in line.upper().replace(b" ", b""):
+                return year
+
+    for line in lines[:1]:
+        for year, column_specs in ssc_formats.items():
+            _, end = column_specs["X"]
+            if line[end-5:end-4] == b".":
+                return year
+
+    raise ValueError("Unknown SSC format, expected an ITRF2008 or ITRF2014 style file")
+
+def parse_ssc_fwf(fpath: str):
+    """Parse a .ssc TRF file to a pandas dataframe with two passes of pandas.read_fwf, kept as a reference for parse_ssc"""
         
     column_names = ["Domes", "Station_Name", "Tech", "Code", "X", "Y", "Z", "X_sigma", "Y_sigma", "Z_sigma", "Soln"]
     column_names_rate = ["Domes", "Station_Name", "Code", "X_v", "Y_v", "Z_v", "X_v_sigma", "Y_v_sigma", "Z_v_sigma", "Soln"]
+    epoch = ssc_epochs["2008" if "2008" in fpath else "2014"]
     if "2008" in fpath:
         column_specs = [(0,9),(9,25),(25,31),(31,36),(36,49),(49,62),(62,75),(75,81),(81,87),(87,93),(95,96)]
         column_specs_rate = [(0, 9), (9, 25),(31,36),(42, 49),(55, 62),(68, 75),(75, 81),(81, 87),(87,93), (95,96)]
@@ -60,18 +180,454 @@ def load_ssc(fpath: str):
     df_rate = df_rate.set_index(df_rate.Domes.rename("index"))
     
     df = df.merge(df_rate, how="inner", on=["Domes", "Soln", "Code"])
+    df["Epoch"] = epoch
+    df = calculate_long_lat(df)
+
+    return df
+
+def load_snx(fpath: str, epoch: float = None, cache: bool = True):
+    """Load a SINEX .snx solution file to a pandas dataframe, cached on disk unless cache is False, with positions propagated to epoch if given"""
+    df = load_cached(parse_snx, fpath, cache)
+    return propagate_epoch(df, epoch) if epoch else df
+
+def parse_snx(fpath: str):
+    """Parse station coordinates, velocities and their 3x3 covariance blocks from a SINEX file to a pandas dataframe.
+
+    Estimates are read from SOLUTION/ESTIMATE and covariances (COVA or CORR) from SOLUTION/MATRIX_ESTIMATE, which is 
+    streamed so that only entries between the X, Y and Z components of the same station are kept. The off diagonal 
+    covariances are stored in the XY_cov, XZ_cov and YZ_cov columns (and X_v/Y_v/Z_v with _cov for velocities)."""
+    components = {"STAX" : ("X", 0), "STAY" : ("Y", 0), "STAZ" : ("Z", 0),
+                  "VELX" : ("X_v", 1), "VELY" : ("Y_v", 1), "VELZ" : ("Z_v", 1)}
+    sites = {}
+    estimates = {}
+    parameters = {}
+    station_spans = {}
+    matrix_entries = {}
+    matrix_type = None
+    block = None
+
+    with open(fpath, "r", encoding="latin-1") as f:
+        for line in f:
+            if line.startswith("+"):
+                block = line[1:].split()[0]
+                if block == "SOLUTION/MATRIX_ESTIMATE":
+                    matrix_type = line.split()[2]
+                    if matrix_type == "INFO":
+                        raise ValueError("SINEX normal equation (INFO) matrices are not supported, expected COVA or CORR")
+                continue
+            if line.startswith("-"):
+                block = None
+                continue
+            if line.startswith("*") or block is None:
+                continue
+
+            if block == "SITE/ID":
+                sites[(line[1:5].strip(), line[6:8].strip())] = (line[9:18].strip(), line[21:43].strip())
+
+            elif block == "SOLUTION/ESTIMATE":
+                fields = line.split()
+                if fields[1] in components:
+                    station = (fields[2], fields[3], fields[4])
+                    name, order = components[fields[1]]
+                    estimates.setdefault(station, {"Date" : fields[5]})
+                    estimates[station][name] = float(fields[8])
+                    estimates[station][name + "_sigma"] = float(fields[9])
+                    parameters[int(fields[0])] = (station, name, order)
+                    first, last = station_spans.get(station, (int(fields[0]), int(fields[0])))
+                    station_spans[station] = (min(first, int(fields[0])), max(last, int(fields[0])))
+
+            elif block == "SOLUTION/MATRIX_ESTIMATE":
+                row, column, values = line.split(None, 2)
+                row, column = int(row), int(column)
+                if not row in parameters:
+                    continue
+
+                #Skip lines outside the block of the station quickly, most of a full matrix
+                first, last = station_spans[parameters[row][0]]
+                if column > last or column + 2 < first:
+                    continue
+
+                for column, value in enumerate(values.split(), column):
+                    if column in parameters and parameters[column][0] == parameters[row][0] and parameters[column][2] == parameters[row][2]:
+                        matrix_entries[(row, column)] = float(value)
+
+    #Convert correlations to covariances and store the elements of each station block, the matrix diagonal holds 
+    #more digits than the estimate standard deviations
+    for (row, column), value in matrix_entries.items():
+        station, row_name, _ = parameters[row]
+        _, column_name, _ = parameters[column]
+        if row == column:
+            estimates[station][row_name + "_sigma"] = value if matrix_type == "CORR" else np.sqrt(value)
+            continue
+        if matrix_type == "CORR":
+            value = value * matrix_entries.get((row, row), np.nan) * matrix_entries.get((column, column), np.nan)
+        row_name, column_name = sorted([row_name, column_name])
+        suffix = "_v_cov" if row_name.endswith("_v") else "_cov"
+        estimates[station][row_name[0] + column_name[0] + suffix] = value
+
+    rows = []
+    for (code, point, soln), estimate in estimates.items():
+        domes, description = sites.get((code, point), ("", ""))
+        rows.append({"Domes" : domes, "Station_Name" : description or code, "Code" : code, "Soln" : soln, **estimate})
+
+    columns = ["Domes", "Station_Name", "Code", "Soln", "Date", "X", "Y", "Z", "X_sigma", "Y_sigma", "Z_sigma", "XY_cov", "XZ_cov", "YZ_cov"]
+    columns = columns + list(dict.fromkeys(column for row in rows for column in row if not column in columns))
+    df = pd.DataFrame(rows, columns = columns)
+    df = df.dropna(subset=["X", "Y", "Z"]).reset_index(drop=True)
+    df.Soln = pd.to_numeric(df.Soln, errors="coerce").fillna(1)
+    df[["XY_cov", "XZ_cov", "YZ_cov"]] = df[["XY_cov", "XZ_cov", "YZ_cov"]].fillna(0.0)
+
+    df["Date"] = timestamp_to_year(pd.Series([sinex_epoch_to_timestamp(epoch) for epoch in df.Date], dtype="datetime64[ns]"))
+    df["Epoch"] = df["Date"]
     df = calculate_long_lat(df)
 
     return df
 
-def calculate_long_lat(df: pd.DataFrame):
-    """Add columns with LONG/LAT cooridnates to df derived from XYZ coordinates from df"""
+def sinex_epoch_to_timestamp(epoch: str):
+    """Converts a SINEX YY:DDD:SSSSS epoch to a pandas timestamp"""
+    year, day, seconds = (int(value) for value in epoch.split(":"))
+    year = year + (1900 if year > 50 else 2000)
+
+    return pd.Timestamp(year=year, month=1, day=1) + pd.Timedelta(days=day-1, seconds=seconds)
+
+def load_frame(fpath: str, epoch: float = None, cache: bool = True):
+    """Load a .sta, .ssc or .snx TRF file to a pandas dataframe, choosing the loader from the file extension"""
+    loaders = {".sta" : load_sta, ".ssc" : load_ssc, ".snx" : load_snx}
+    _, extension = os.path.splitext(fpath)
+    if not extension.lower() in loaders:
+        raise ValueError(f"Unknown file format '{extension}', expected one of {list(loaders)}")
+
+    return loaders[extension.lower()](fpath, epoch = epoch, cache = cache)
+
+def build_catalogue(directory: str, fpaths: list):
+    """Builds an indexed station catalogue in directory from a list of .sta, .ssc and .snx files and returns it opened.
+
+    Every column is written as a .npy array (text as fixed width unicode) so it can be memory mapped, together with 
+    sorted lookup keys for each of StationCatalogue.index_keys."""
+    df = pd.concat([load_frame(fpath) for fpath in fpaths], ignore_index = True)
+    os.makedirs(directory, exist_ok = True)
+
+    columns = {}
+    for name, series in df.items():
+        values = series.to_numpy()
+        if values.dtype == object:
+            values = series.fillna("").astype(str).to_numpy().astype(str)
+        np.save(os.path.join(directory, f"column_{name}.npy"), values)
+        columns[name] = values
+
+    for index_name, key_names in StationCatalogue.index_keys.items():
+        if all(name in columns for name in key_names):
+            keys = StationCatalogue.get_keys([columns[name] for name in key_names])
+            order = np.argsort(keys, kind = "stable")
+            np.save(os.path.join(directory, f"index_{index_name}_keys.npy"), keys[order])
+            np.save(os.path.join(directory, f"index_{index_name}_order.npy"), order)
+
+    with open(os.path.join(directory, "catalogue.json"), "w") as f:
+        json.dump({"columns" : list(columns), "sources" : [os.path.abspath(fpath) for fpath in fpaths]}, f)
+
+    return StationCatalogue(directory)
+
+class StationCatalogue:
+    """Station catalogue written by build_catalogue, opened in constant time by memory mapping its column arrays.
+
+    Stations are looked up through sorted keys on DOMES number, site code, station name or the DOMES/Code/Soln 
+    combination, so only the matching rows are read from disk."""
+
+    index_keys = {"Domes" : ["Domes"], 
+                  "Code" : ["Code"], 
+                  "Station_Name" : ["Station_Name"], 
+                  "Station" : ["Domes", "Code", "Soln"]}
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "catalogue.json")) as f:
+            meta = json.load(f)
+
+        self.sources = meta["sources"]
+        self.columns = {name : np.load(os.path.join(directory, f"column_{name}.npy"), mmap_mode = "r") for name in meta["columns"]}
+        self.indexes = {}
+        for index_name in self.index_keys:
+            keys_path = os.path.join(directory, f"index_{index_name}_keys.npy")
+            if os.path.exists(keys_path):
+                self.indexes[index_name] = (np.load(keys_path, mmap_mode = "r"), 
+                                            np.load(os.path.join(directory, f"index_{index_name}_order.npy"), mmap_mode = "r"))
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @staticmethod
+    def get_keys(columns: list):
+        """Returns the lookup keys of rows from a list of key columns"""
+        columns = [np.char.mod("%g", column) if np.issubdtype(np.asarray(column).dtype, np.number) else np.asarray(column).astype(str) for column in columns]
+        keys = columns[0]
+        for column in columns[1:]:
+            keys = np.char.add(np.char.add(keys, "|"), column)
+        return keys
+
+    def find(self, **keys):
+        """Returns the row numbers of all stations matching any of the given key values, e.g. find(Domes = [...]) or 
+        find(Domes = [...], Code = [...], Soln = [...]) for element wise combinations"""
+        index_name = next((name for name, key_names in self.index_keys.items() if sorted(key_names) == sorted(keys)), None)
+        if not index_name in self.indexes:
+            raise ValueError(f"No catalogue index on {list(keys)}, expected one of {list(self.index_keys.values())}")
+
+        sorted_keys, order = self.indexes[index_name]
+        query = self.get_keys([np.atleast_1d(keys[name]) for name in self.index_keys[index_name]])
+        first = np.searchsorted(sorted_keys, query, side = "left")
+        last = np.searchsorted(sorted_keys, query, side = "right")
+
+        return np.concatenate([order[start:end] for start, end in zip(first, last)] + [np.array([], dtype = np.int64)])
+
+    def lookup(self, **keys):
+        """Returns the stations matching the given key values as a dataframe, see find"""
+        return self.to_dataframe(self.find(**keys))
+
+    def to_dataframe(self, rows = None):
+        """Reads the given row numbers (all stations if None) to a dataframe"""
+        rows = slice(None) if rows is None else np.asarray(rows)
+        df = pd.DataFrame({name : np.asarray(column[rows]) for name, column in self.columns.items()})
+
+        return df
+
+def open_catalogue(directory: str):
+    """Opens a station catalogue written by build_catalogue"""
+    return StationCatalogue(directory)
+
+StationMatch = namedtuple("StationMatch", ["index_from", "index_to", "unmatched_from", "unmatched_to", "duplicates_from", "duplicates_to"])
+
+#Named key combinations for match_stations
+match_keys = {"name" : ["Station_Name"], 
+              "domes" : ["Domes"], 
+              "code_soln" : ["Code", "Soln"],
+              "station" : ["Domes", "Code", "Soln"]}
+
+def match_stations(df_from: pd.DataFrame, df_to: pd.DataFrame, keys = "name"):
+    """Matches the stations of two frames on key columns (a list of column names or a key of match_keys) through a 
+    hash index, in linear time.
+
+    Returns a StationMatch of positional index arrays aligning the matched stations of both frames, positions of the 
+    stations without a match in either frame and the keys occurring more than once in each frame, of which only the 
+    first occurrence is matched."""
+    keys = match_keys.get(keys, keys) if isinstance(keys, str) else list(keys)
+    keys_from = list(zip(*[df_from[key].tolist() for key in keys]))
+    keys_to = list(zip(*[df_to[key].tolist() for key in keys]))
+
+    def build_index(frame_keys):
+        index, duplicates = {}, {}
+        for position, key in enumerate(frame_keys):
+            if key in index:
+                duplicates[key] = duplicates.get(key, 1) + 1
+            else:
+                index[key] = position
+        return index, duplicates
+
+    index_from, duplicates_from = build_index(keys_from)
+    index_to, duplicates_to = build_index(keys_to)
+
+    matched_from = [position for key, position in index_from.items() if key in index_to]
+    matched_to = [index_to[key] for key, position in index_from.items() if key in index_to]
+    unmatched_from = [position for key, position in index_from.items() if not key in index_to]
+    unmatched_to = [position for key, position in index_to.items() if not key in index_from]
+
+    return StationMatch(np.array(matched_from, dtype=np.int64), np.array(matched_to, dtype=np.int64), 
+                        np.array(unmatched_from, dtype=np.int64), np.array(unmatched_to, dtype=np.int64),
+                        duplicates_from, duplicates_to)
+
+def align_frames(df_from: pd.DataFrame, df_to: pd.DataFrame, keys = "name"):
+    """Returns the matched stations of two frames in the same row order with a shared index, and the StationMatch"""
+    match = match_stations(df_from, df_to, keys)
+    df_from = df_from.iloc[match.index_from].reset_index(drop=True)
+    df_to = df_to.iloc[match.index_to].reset_index(drop=True)
+
+    return df_from, df_to, match
+
+def load_cached(parser, fpath: str, cache: bool = True):
+    """Returns parser(fpath), reusing a binary copy of the parsed frame from the on disk cache when the file is unchanged.
+
+    Entries are .npz files of the frame columns keyed by the file path and parser. An entry is valid if the file size 
+    and modification time match, or if the size matches and the content hash is unchanged. The least recently used 
+    entries are evicted when the cache grows beyond cache_max_bytes."""
+    if not cache:
+        return parser(fpath)
+
+    fpath = os.path.abspath(fpath)
+    stat = os.stat(fpath)
+    key = hashlib.sha1(f"{cache_version}:{parser.__name__}:{fpath}".encode()).hexdigest()
+    entry_path = os.path.join(cache_directory, key + ".npz")
+
+    content_hash = None
+    try:
+        with np.load(entry_path, allow_pickle=False) as entry:
+            meta = json.loads(str(entry["meta"]))
+            is_valid = meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime_ns
+            if not is_valid and meta["size"] == stat.st_size:
+                content_hash = get_file_hash(fpath)
+                is_valid = meta["hash"] == content_hash
+            if is_valid:
+                df = frame_from_arrays(meta, entry)
+                if meta["mtime"] == stat.st_mtime_ns:
+                    os.utime(entry_path)
+                    return df
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        is_valid = False
+
+    if not is_valid:
+        df = parser(fpath)
+
+    meta = {"path" : fpath, 
+            "size" : stat.st_size, 
+            "mtime" : stat.st_mtime_ns, 
+            "hash" : content_hash or get_file_hash(fpath)}
+    save_cache_entry(entry_path, meta, df)
+
+    return df
+
+def get_file_hash(fpath: str):
+    """Returns a hash of the file content"""
+    file_hash = hashlib.blake2b()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            file_hash.update(block)
 
-    df["LAT"] = np.degrees(np.arcsin(df.Z/np.sqrt(df.X**2 + df.Y**2 + df.Z**2)))
-    df["LONG"] = np.degrees(np.arctan2(df.Y, df.X))
+    return file_hash.hexdigest()
+
+def frame_to_arrays(df: pd.DataFrame):
+    """Returns the columns and index of df as plain numpy arrays and a description needed to restore the frame"""
+    arrays = {}
+    columns = []
+    for i, (name, series) in enumerate([(df.index.name, df.index.to_series()), *df.items()]):
+        values = series.to_numpy()
+        is_text = values.dtype == object
+        if is_text:
+            arrays[f"null{i}"] = series.isna().to_numpy()
+            values = series.astype(str).to_numpy().astype(str)
+        arrays[f"column{i}"] = values
+        columns.append({"name" : name, "text" : bool(is_text)})
+
+    columns[0]["range"] = isinstance(df.index, pd.RangeIndex) and df.index.equals(pd.RangeIndex(len(df.index)))
+
+    return {"columns" : columns[1:], "index" : columns[0]}, arrays
+
+def frame_from_arrays(meta: dict, arrays):
+    """Restores a frame stored by frame_to_arrays"""
+    def restore(i, description):
+        values = arrays[f"column{i}"]
+        if description["text"]:
+            values = values.astype(object)
+            values[arrays[f"null{i}"]] = np.nan
+        return values
+
+    if meta["index"]["range"]:
+        index = pd.RangeIndex(len(arrays["column0"]), name = meta["index"]["name"])
+    else:
+        index = pd.Index(restore(0, meta["index"]), name = meta["index"]["name"])
+    data = {column["name"] : restore(i, column) for i, column in enumerate(meta["columns"], 1)}
+
+    return pd.DataFrame(data, index = index)
+
+def save_cache_entry(entry_path: str, meta: dict, df: pd.DataFrame):
+    """Atomically writes a cache entry and evicts old entries, failing silently if the cache directory is not writable. 
+    Each write goes through its own temporary file, so concurrent loads of the same file never mix their entries."""
+    description, arrays = frame_to_arrays(df)
+    meta.update(description)
+
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir = cache_directory, suffix = ".tmp")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.savez(f, meta = np.array(json.dumps(meta)), **arrays)
+            os.replace(temporary_path, entry_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        evict_cache()
+    except OSError:
+        pass
+
+def evict_cache(max_bytes: int = None):
+    """Removes the least recently used cache entries until the cache is smaller than max_bytes"""
+    max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+    entries = [entry.path for entry in os.scandir(cache_directory) if entry.name.endswith(".npz")]
+    entries = sorted(entries, key = os.path.getmtime)
+    total_bytes = sum(os.path.getsize(entry) for entry in entries)
+
+    for entry in entries:
+        if total_bytes <= max_bytes:
+            break
+        total_bytes -= os.path.getsize(entry)
+        os.remove(entry)
+
+def clear_cache():
+    """Removes all entries from the on disk cache"""
+    if os.path.isdir(cache_directory):
+        evict_cache(0)
+
+def propagate_epoch(df: pd.DataFrame, epoch: float, columns: list = None):
+    """Returns a copy of the frame with positions propagated from the reference epoch in its Epoch column to epoch.
+
+    Positions move along the velocity columns and their variances (and covariances) grow with those of the velocities, 
+    in one vectorized operation. columns restricts the copy to those columns (and the ones needed for the propagation), 
+    which avoids copying the whole frame when scanning many epochs at fit time."""
+    if not all(name in df for name in ["X_v", "Y_v", "Z_v", "Epoch"]):
+        raise ValueError("Epoch propagation requires the velocity columns X_v, Y_v, Z_v and a reference Epoch column")
+
+    if columns is not None:
+        needed = ["X", "Y", "Z", "X_v", "Y_v", "Z_v", "Epoch", "X_sigma", "Y_sigma", "Z_sigma", "X_v_sigma", "Y_v_sigma", "Z_v_sigma",
+                  "XY_cov", "XZ_cov", "YZ_cov", "XY_v_cov", "XZ_v_cov", "YZ_v_cov"]
+        df = df[[name for name in df if name in columns or name in needed]]
+    df = df.copy()
+
+    dt = (epoch - df["Epoch"].to_numpy(dtype=np.float64)).reshape(-1, 1)
+    df[["X", "Y", "Z"]] = df[["X", "Y", "Z"]].to_numpy() + dt * df[["X_v", "Y_v", "Z_v"]].to_numpy()
+
+    sigmas, velocity_sigmas = ["X_sigma", "Y_sigma", "Z_sigma"], ["X_v_sigma", "Y_v_sigma", "Z_v_sigma"]
+    if all(name in df for name in sigmas + velocity_sigmas):
+        df[sigmas] = np.sqrt(df[sigmas].to_numpy()**2 + dt**2 * df[velocity_sigmas].to_numpy()**2)
+
+    covariances, velocity_covariances = ["XY_cov", "XZ_cov", "YZ_cov"], ["XY_v_cov", "XZ_v_cov", "YZ_v_cov"]
+    if all(name in df for name in covariances + velocity_covariances):
+        df[covariances] = df[covariances].to_numpy() + dt**2 * df[velocity_covariances].to_numpy()
+
+    df["Epoch"] = epoch
+    if "LAT" in df:
+        df = calculate_long_lat(df)
+
+    return df
+
+def calculate_long_lat(df: pd.DataFrame, ellipsoid: str = "GRS80"):
+    """Add columns with geodetic LONG/LAT cooridnates on ellipsoid to df derived from XYZ coordinates from df"""
+    lat, long, _ = ecef_to_geodetic(df[["X", "Y", "Z"]].to_numpy(dtype=np.float64), ellipsoid)
+
+    df["LAT"] = lat
+    df["LONG"] = long
 
     return df
 
+def ecef_to_geodetic(xyz, ellipsoid: str = "GRS80"):
+    """Converts (..., 3) geocentric cartesian coordinates to geodetic latitude and longitude in degrees and ellipsoidal 
+    height in metres on one of ellipsoids, by Bowring's formula refined twice (sub-millimetre for terrestrial points)"""
+    semi_major_axis, flattening = ellipsoids[ellipsoid]
+    semi_minor_axis = semi_major_axis * (1 - flattening)
+    eccentricity_squared = flattening * (2 - flattening)
+    second_eccentricity_squared = eccentricity_squared / (1 - flattening)**2
+
+    x, y, z = np.moveaxis(np.asarray(xyz, dtype=np.float64), -1, 0)
+    p = np.hypot(x, y)
+    long = np.arctan2(y, x)
+
+    reduced_lat = np.arctan2(z, (1 - flattening) * p)
+    for _ in range(3):
+        lat = np.arctan2(z + second_eccentricity_squared * semi_minor_axis * np.sin(reduced_lat)**3, 
+                         p - eccentricity_squared * semi_major_axis * np.cos(reduced_lat)**3)
+        reduced_lat = np.arctan2((1 - flattening) * np.sin(lat), np.cos(lat))
+
+    sin_lat = np.sin(lat)
+    prime_vertical_radius = semi_major_axis / np.sqrt(1 - eccentricity_squared * sin_lat**2)
+    height = p * np.cos(lat) + (z + eccentricity_squared * prime_vertical_radius * sin_lat) * sin_lat - prime_vertical_radius
+
+    return np.degrees(lat), np.degrees(long), height
+
 def timestamp_to_year(timestamp):
     jd = pd.DatetimeIndex(timestamp).to_julian_date()
     jd2000 = pd.Timestamp(year=2000, month=1, day=1).to_julian_date()
@@ -95,6 +651,8 @@ def get_path(file_name):
 
 def to_string(df_from, df_to, df_transformed, parameters, sigmas):
 
+    #Missing scale_y and scale_z of 7 and 8 parameter fits equal scale_x, as in calc.transform_array
+    parameters = {**parameters, "scale_y" : parameters.get("scale_y", parameters["scale_x"]), "scale_z" : parameters.get("scale_z", parameters["scale_x"])}
     transformation = [name for name in sigmas.keys()]
     values = [parameters[name] for name in sigmas.keys()]
     sigmas = [sigmas[name] for name in sigmas.keys()]
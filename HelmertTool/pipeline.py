@@ -0,0 +1,167 @@
+import pandas as pd
+import numpy as np
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from HelmertTool.io import load_frame, align_frames
+from HelmertTool.calc import NormalEquations, calculate_leave_one_out, helmert_transform, calculate_residuals, decompose_residuals
+
+class Pipeline:
+    """Memoized computation pipeline from two frames to the residuals and statistics of a Helmert transform.
+
+    The stages load -> match -> select -> normal equations -> solve -> transform -> residuals -> ENU -> statistics are
+    run on demand by get. Each stage is cached under a hash of its own inputs and the keys of the stages it depends on,
+    so a stage is only recomputed if something upstream of it changed. The cache holds at most max_entries results and
+    evicts the least recently used. Usable from scripts:
+
+        pipeline = Pipeline()
+        pipeline.set(frame_from = "ITRF2014.SSC", frame_to = "ITRF2008.SSC", weighted = True, type = "7")
+        parameters, sigmas = pipeline.get("solve")
+        pipeline.set(type = "9")
+        parameters, sigmas = pipeline.get("solve") #Reuses the loaded frames and normal equations
+        pipeline.use_solution()
+        chi_squared, wrms = pipeline.get("statistics")
+
+    The inputs are frame_from and frame_to (file paths or dataframes), keys (see io.match_stations), selection (a
+    boolean array over the matched stations, None for all), weighted, type, custom_dict and parameters (the values to
+    transform with). Results are shared between calls and must not be modified."""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.inputs = {"frame_from" : None, "frame_to" : None, "keys" : "name", "selection" : None,
+                       "weighted" : False, "type" : "7", "custom_dict" : None, "parameters" : None}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def set(self, **inputs):
+        """Set pipeline inputs"""
+        for name in inputs:
+            if not name in self.inputs:
+                raise ValueError(f"Unknown pipeline input '{name}', expected one of {list(self.inputs)}")
+        if not inputs.get("selection") is None:
+            inputs["selection"] = np.array(inputs["selection"], dtype=bool)
+        self.inputs.update(inputs)
+
+    def use_solution(self):
+        """Set the transform parameters to the solved ones"""
+        self.set(parameters = self.get("solve")[0])
+
+    def snapshot(self):
+        """Returns a copy of the current inputs, to run get on from another thread while the inputs keep changing"""
+        return dict(self.inputs)
+
+    def get(self, stage: str, inputs: dict = None):
+        """Returns the result of stage for inputs (the current inputs if None), running it and its dependencies as needed"""
+        return self.run(stage, inputs or self.inputs, {})
+
+    def cached(self, stage: str, inputs: dict = None):
+        """Check if the result of stage for inputs is cached, without running anything"""
+        return self.get_key(stage, inputs or self.inputs, {}) in self.cache
+
+    def get_key(self, stage: str, inputs: dict, known: dict):
+        """Returns the cache key of stage, known holds the keys already computed in this call"""
+        if not stage in known:
+            dependencies, input_names, _ = stages[stage]
+            key = hashlib.blake2b(stage.encode(), digest_size=16)
+            for dependency in dependencies:
+                key.update(self.get_key(dependency, inputs, known).encode())
+            for name in input_names:
+                key.update(fingerprint(inputs[name]))
+            known[stage] = key.hexdigest()
+
+        return known[stage]
+
+    def run(self, stage: str, inputs: dict, known: dict):
+        """Returns the result of stage from the cache, or runs it on the results of its dependencies"""
+        key = self.get_key(stage, inputs, known)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        dependencies, input_names, function = stages[stage]
+        values = [self.run(dependency, inputs, known) for dependency in dependencies]
+        result = function(*values, *[inputs[name] for name in input_names])
+
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last = False)
+
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+def fingerprint(value):
+    """Returns bytes identifying a pipeline input, file paths include the size and modification time of the file"""
+    if isinstance(value, pd.DataFrame):
+        return hashlib.blake2b(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes(), digest_size=16).digest()
+    if isinstance(value, np.ndarray):
+        return hashlib.blake2b(value.tobytes() + str(value.dtype).encode(), digest_size=16).digest()
+    if isinstance(value, dict):
+        return repr(sorted(value.items())).encode()
+    if isinstance(value, str) and os.path.isfile(value):
+        stat = os.stat(value)
+        return repr((os.path.abspath(value), stat.st_size, stat.st_mtime_ns)).encode()
+    return repr(value).encode()
+
+def load(frame):
+    """Load stage, frame is a file path or an already loaded dataframe"""
+    if frame is None:
+        raise ValueError("No frame given")
+    return frame if isinstance(frame, pd.DataFrame) else load_frame(frame)
+
+def select(match, selection):
+    """Select stage, returns the selected stations of the matched frames"""
+    df_from, df_to, _ = match
+    if selection is None:
+        return df_from, df_to
+    return df_from[selection], df_to[selection]
+
+def accumulate(selected, weighted):
+    return NormalEquations(weighted).add_frames(*selected)
+
+def solve(normal_equations, type, custom_dict):
+    return normal_equations.solve(type, custom_dict)
+
+def influence(selected, weighted, type, custom_dict):
+    """Influence (Cook's distance) of each selected station on the fit"""
+    return calculate_leave_one_out(*selected, weighted, type, custom_dict)[2]
+
+def transform(selected, parameters):
+    if parameters is None:
+        raise ValueError("No transform parameters set, see Pipeline.use_solution")
+    return helmert_transform(selected[0], parameters)
+
+def residuals(transformed, selected):
+    return calculate_residuals(transformed.copy(), selected[1])
+
+def decompose(residual_frame):
+    return decompose_residuals(residual_frame.copy())
+
+def statistics(transformed, selected, type):
+    """Returns the chi squared per degree of freedom and the weighted root mean square of the residuals"""
+    df_from, df_to = selected
+
+    weighted_sum = sum(transformed.dX ** 2 / (df_from.X_sigma**2 + df_to.X_sigma**2) + transformed.dY ** 2 / (df_from.Y_sigma**2 + df_to.Y_sigma**2) + transformed.dZ ** 2 / (df_from.Z_sigma**2 + df_to.Z_sigma**2))
+    normalize_constant = sum(1 / (df_from.X_sigma**2 + df_to.X_sigma**2) + 1 / (df_from.Y_sigma**2 + df_to.Y_sigma**2) + 1 / (df_from.Z_sigma**2 + df_to.Z_sigma**2))
+
+    deg_of_freedom = 3*len(df_from.index) - float(type)
+    return weighted_sum/deg_of_freedom, weighted_sum/normalize_constant
+
+#Stage name : (stages it depends on, pipeline inputs, function of the dependency results and inputs)
+stages = {"load_from" : ([], ["frame_from"], load),
+          "load_to" : ([], ["frame_to"], load),
+          "match" : (["load_from", "load_to"], ["keys"], align_frames),
+          "select" : (["match"], ["selection"], select),
+          "normal_equations" : (["select"], ["weighted"], accumulate),
+          "solve" : (["normal_equations"], ["type", "custom_dict"], solve),
+          "influence" : (["select"], ["weighted", "type", "custom_dict"], influence),
+          "transform" : (["select"], ["parameters"], transform),
+          "residuals" : (["transform", "select"], [], residuals),
+          "enu" : (["residuals"], [], decompose),
+          "statistics" : (["enu", "select"], ["type"], statistics)}
@@ -0,0 +1,111 @@
+import pandas as pd
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from HelmertTool.io import propagate_epoch
+from HelmertTool.calc import get_frame_observations, get_frame_covariance, has_covariance, get_design_blocks, get_station_weights, get_station_normals, get_parameter_map, add_soft_constraints, solve_normal_equations
+
+def bootstrap(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, n_replicates: int = 1000, batch_size: int = 250, workers: int = None, seed: int = 0, epoch: float = None):
+    """Bootstrap uncertainties of the Helmert parameters by refitting on stations resampled with replacement.
+
+    Returns a dataframe of the replicate parameters and their empirical covariance matrix, see run_replicates."""
+    return run_replicates("bootstrap", df_from, df_to, weighted, type, custom_dict, n_replicates, batch_size, workers, seed, epoch)
+
+def monte_carlo(df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, n_replicates: int = 1000, batch_size: int = 250, workers: int = None, seed: int = 0, epoch: float = None):
+    """Monte Carlo uncertainties of the Helmert parameters by refitting on coordinates of both frames perturbed by
+    their X_sigma, Y_sigma and Z_sigma (and XY_cov, XZ_cov and YZ_cov if present).
+
+    Returns a dataframe of the replicate parameters and their empirical covariance matrix, see run_replicates."""
+    return run_replicates("monte_carlo", df_from, df_to, weighted, type, custom_dict, n_replicates, batch_size, workers, seed, epoch)
+
+def run_replicates(method: str, df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool, type: str, custom_dict: dict = None, n_replicates: int = 1000, batch_size: int = 250, workers: int = None, seed: int = 0, epoch: float = None):
+    """Runs n_replicates bootstrap or monte_carlo fits of two aligned frames, vectorized in batches of batch_size
+    replicates spread over a process pool of workers processes (in process if workers is 1).
+
+    Each batch draws from its own child of numpy.random.SeedSequence(seed), so the results only depend on seed and
+    batch_size and not on the number of workers. Returns a dataframe of the replicate parameters and their empirical
+    covariance matrix, comparable to the analytic covariance of a weighted calculate_parameters fit."""
+    if not method in batch_methods:
+        raise ValueError(f"Unknown method '{method}', expected one of {list(batch_methods)}")
+
+    if epoch is not None:
+        df_from = propagate_epoch(df_from, epoch, columns = [])
+        df_to = propagate_epoch(df_to, epoch, columns = [])
+
+    data = get_replicate_data(method, df_from, df_to, weighted)
+    sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(method, data, seed_sequence, size, type, custom_dict) for seed_sequence, size in zip(seeds, sizes)]
+
+    if workers == 1:
+        results = [run_batch(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+            results = list(executor.map(run_batch, *zip(*arguments)))
+
+    names = get_parameter_map(type, custom_dict)[0]
+    replicates = pd.DataFrame(np.vstack(results), columns = names)
+
+    return replicates, replicates.cov()
+
+def get_replicate_data(method: str, df_from: pd.DataFrame, df_to: pd.DataFrame, weighted: bool):
+    """Returns the arrays a replicate batch needs, the per station normal equations for the bootstrap and the
+    coordinates, their error factors and the observation weights for the monte carlo method"""
+    xyz, observations, var = get_frame_observations(df_from, df_to, weighted)
+    weights = get_station_weights(var, len(xyz), weighted)
+
+    if method == "bootstrap":
+        normal_matrix, normal_vector, _ = get_station_normals(get_design_blocks(xyz), weights, observations)
+        return {"normal_matrix" : normal_matrix, "normal_vector" : normal_vector}
+
+    return {"xyz_from" : xyz,
+            "xyz_to" : df_to[["X", "Y", "Z"]].to_numpy(),
+            "lower_from" : get_error_factor(df_from),
+            "lower_to" : get_error_factor(df_to),
+            "weights" : np.ascontiguousarray(weights)}
+
+def get_error_factor(df: pd.DataFrame):
+    """Returns (n, 3, 3) lower triangular factors L of the coordinate covariances of a frame, so L @ z with standard
+    normal z is a draw of its coordinate errors"""
+    if has_covariance(df):
+        return np.linalg.cholesky(get_frame_covariance(df))
+
+    return np.eye(3) * df[["X_sigma", "Y_sigma", "Z_sigma"]].to_numpy()[:, np.newaxis, :]
+
+def run_batch(method: str, data: dict, seed_sequence, size: int, type: str, custom_dict: dict = None):
+    """Fits a batch of size replicates in one stacked solve, returns a (size, k) array of parameters"""
+    rng = np.random.default_rng(seed_sequence)
+    normal_matrix, normal_vector = batch_methods[method](data, rng, size)
+
+    names, combination, fixed_values = get_parameter_map(type, custom_dict)
+    normal_vector = (normal_vector - normal_matrix @ fixed_values) @ combination
+    normal_matrix = combination.T @ normal_matrix @ combination
+    normal_matrix, normal_vector, _, _ = add_soft_constraints(names, normal_matrix, normal_vector, 0, custom_dict)
+    parameters, _, _ = solve_normal_equations(normal_matrix, normal_vector)
+
+    return parameters
+
+def bootstrap_batch(data: dict, rng, size: int):
+    """Normal equations of size station resamples, weighting the per station contributions by their draw counts"""
+    n = len(data["normal_matrix"])
+    counts = rng.multinomial(n, np.full(n, 1/n), size = size).astype(np.float64)
+
+    normal_matrix = np.einsum("bn,nij->bij", counts, data["normal_matrix"], optimize=True)
+    normal_vector = np.einsum("bn,ni->bi", counts, data["normal_vector"], optimize=True)
+
+    return normal_matrix, normal_vector
+
+def monte_carlo_batch(data: dict, rng, size: int):
+    """Normal equations of size perturbations of the coordinates of both frames"""
+    shape = (size, *data["xyz_from"].shape, 1)
+    xyz_from = data["xyz_from"] + (data["lower_from"] @ rng.standard_normal(shape))[..., 0]
+    xyz_to = data["xyz_to"] + (data["lower_to"] @ rng.standard_normal(shape))[..., 0]
+
+    blocks = get_design_blocks(xyz_from)
+    normal_matrix = np.einsum("bnki,nkl,bnlj->bij", blocks, data["weights"], blocks, optimize=True)
+    normal_vector = np.einsum("bnki,nkl,bnl->bi", blocks, data["weights"], xyz_to - xyz_from, optimize=True)
+
+    return normal_matrix, normal_vector
+
+batch_methods = {"bootstrap" : bootstrap_batch, "monte_carlo" : monte_carlo_batch}
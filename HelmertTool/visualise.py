@@ -4,6 +4,18 @@ import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from HelmertTool.io import get_path 
 
+#Decoded basemaps by maximum width, the image file is only read once
+basemap_cache = {}
+
+def get_basemap(max_width: int = 1024):
+    """Returns the world map image, read once and downsampled by striding to at most max_width pixels wide"""
+    if not max_width in basemap_cache:
+        img = mpimg.imread(get_path("map.png"))
+        step = max(1, int(np.ceil(img.shape[1] / max_width)))
+        basemap_cache[max_width] = img[::step, ::step]
+
+    return basemap_cache[max_width]
+
 def plot_sites3D(df: pd.DataFrame):
     fig = plt.figure()
     ax = fig.add_subppytholot(projection='3d')
@@ -13,8 +25,7 @@ def plot_sites3D(df: pd.DataFrame):
 def plot_sites(df: pd.DataFrame, ax: plt.Axes):
     """Plots the station sites scattered over a world map to ax"""
     
-    img = mpimg.imread(get_path("map.png"))
-    ax.imshow(img, extent = (-180,180, -90, 90))
+    ax.imshow(get_basemap(), extent = (-180,180, -90, 90))
     
     ax.scatter(df.LAT, df.LONG, s=4)
     #for x,y,s in zip(df.LAT, df.LONG, df.Station_Name):
@@ -23,7 +34,7 @@ def plot_sites(df: pd.DataFrame, ax: plt.Axes):
     
 def plot_residuals(df, ax1, ax2):
     """Plots UEN-residuals scattered over a world map to axes"""
-    img = mpimg.imread(get_path("map.png"))
+    img = get_basemap()
     ax1.imshow(img, extent = (-180,180, -90, 90))
     ax2.imshow(img, extent = (-180,180, -90, 90))
 
@@ -46,3 +57,86 @@ def plot_residuals_hist(df_from, df_transformed, ax1, ax2):
     ax1.hist([df_from.dU, df_from.dE, df_from.dN], 200, stacked=True)
     ax2.hist([df_transformed.dU, df_transformed.dE, df_transformed.dN], 200, stacked=True)
 
+
+def plot_station_weights(df, weights, ax):
+    """Plots the final station weights of a robust fit scattered over a world map to ax, down weighted stations in red"""
+    ax.imshow(get_basemap(), extent = (-180,180, -90, 90))
+    ax.set_title("Robust station weights")
+
+    sc = ax.scatter(df.LONG, df.LAT, c = weights, s = 8, cmap = "RdYlGn", vmin = 0, vmax = 1)
+    plt.colorbar(sc, ax = ax)
+    ax.grid()
+
+class ResidualPlot:
+    """Residual plot as plot_residuals that is updated in place after a refit.
+
+    The basemaps, titles and grids are drawn once, the quiver artists are kept and updated with set_offsets and 
+    set_UVC. They are animated, so once the figure has been drawn an update restores the cached background of the 
+    axes and blits only the arrows. A full redraw only happens when the number of stations changes."""
+
+    def __init__(self, ax1, ax2):
+        self.axes = [ax1, ax2]
+        self.quivers = [None, None]
+        self.keys = [None, None]
+        self.backgrounds = None
+
+        img = get_basemap()
+        for ax, title in zip(self.axes, ["NE-residual components", "UP-residual component"]):
+            ax.imshow(img, extent = (-180,180, -90, 90))
+            ax.set_title(title)
+            ax.grid()
+
+        self.canvas = ax1.figure.canvas
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        """Cache the backgrounds of the axes after a full draw and draw the arrows on top"""
+        self.backgrounds = [self.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+        self.draw_arrows()
+
+    def draw_arrows(self):
+        for ax, quiver in zip(self.axes, self.quivers):
+            if not quiver is None:
+                ax.draw_artist(quiver)
+
+    def update(self, df):
+        """Show the residuals of df (None to clear them)"""
+        if df is None:
+            self.remove_quivers()
+            self.canvas.draw_idle()
+            return
+
+        offsets = np.column_stack((df.LONG, df.LAT))
+        vectors = [(df.dE.to_numpy(), df.dN.to_numpy()), (np.zeros(len(df.dU)), df.dU.to_numpy())]
+
+        if self.quivers[0] is None or len(self.quivers[0].get_offsets()) != len(offsets):
+            self.remove_quivers()
+            for i, (ax, (u, v)) in enumerate(zip(self.axes, vectors)):
+                self.quivers[i] = ax.quiver(offsets[:, 0], offsets[:, 1], u, v, color="k", scale=2, animated=True)
+                self.keys[i] = ax.quiverkey(self.quivers[i], 0.9,1.05, 10**-1, "0.1m", color = "red")
+            self.canvas.draw_idle()
+            return
+
+        for quiver, (u, v) in zip(self.quivers, vectors):
+            quiver.set_offsets(offsets)
+            quiver.set_UVC(u, v)
+        self.blit()
+
+    def blit(self):
+        """Redraw only the arrows over the cached backgrounds"""
+        if self.backgrounds is None:
+            self.canvas.draw_idle()
+            return
+
+        for background in self.backgrounds:
+            self.canvas.restore_region(background)
+        self.draw_arrows()
+        for ax in self.axes:
+            self.canvas.blit(ax.bbox)
+
+    def remove_quivers(self):
+        for artist in [*self.quivers, *self.keys]:
+            if not artist is None:
+                artist.remove()
+        self.quivers = [None, None]
+        self.keys = [None, None]
@@ -6,8 +6,8 @@ See: https://agupubs.onlinelibrary.wiley.com/doi/full/10.1002/2016JB013098 for d
 #%% Imports
 import pandas as pd
 import numpy as np
-from HelmertTool.load import load_ssc
-from HelmertTool.transform import calculate_parameters
+from HelmertTool.io import load_ssc, propagate_epoch
+from HelmertTool.calc import calculate_parameters
 
 #%% Load data
 #Load defining stations
@@ -46,9 +46,7 @@ df_to = df_to.set_index(df_to.Domes.rename("index"))
 df_to = df_to.sort_index()
 
 #Propagate the data from 2008 to match the epoch of the 2014 data
-df_to.X = df_to.X + 5*df_to.X_v 
-df_to.Y = df_to.Y + 5*df_to.Y_v 
-df_to.Z = df_to.Z + 5*df_to.Z_v 
+df_to = propagate_epoch(df_to, 2010.0)
 
 # %% Calculate a weighted standard 7 parameter transform, the results should match the values given below
 #Parameters : 1.6[mm],	1.9[mm], 2.4[mm], -0.02[ppb],  0.000[mas],  0.000[mas],  0.000[mas]
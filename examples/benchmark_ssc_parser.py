@@ -0,0 +1,33 @@
+"""
+Benchmark of the single pass SSC parser against the read_fwf based reference parser on the ITRF2014 and ITRF2008 files, 
+runnable as a live python script. The files are not distributed with HelmertTool, see https://itrf.ign.fr.
+"""
+
+#%% Imports
+import time
+import pandas as pd
+from HelmertTool.io import parse_ssc, parse_ssc_fwf
+
+#%% Time both parsers and check that they agree
+file_paths = ["data/ITRF2014_GNSS.SSC", "data/ITRF2014_SLR.SSC", "data/ITRF2014_DORIS.SSC", "data/ITRF2014_VLBI.SSC",
+              "data/ITRF2008_GNSS.SSC", "data/ITRF2008_SLR.SSC", "data/ITRF2008_DORIS.SSC", "data/ITRF2008_VLBI.SSC"]
+
+def best_time(parser, file_path, repeats = 3):
+    """Returns the fastest of repeated parses and the parsed frame"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        df = parser(file_path)
+        times.append(time.perf_counter() - start)
+    return min(times), df
+
+for file_path in file_paths:
+    reference_time, reference_df = best_time(parse_ssc_fwf, file_path)
+    single_pass_time, single_pass_df = best_time(parse_ssc, file_path)
+
+    keys = ["Domes", "Soln", "Code"]
+    reference_df = reference_df.sort_values(keys).reset_index(drop=True)
+    single_pass_df = single_pass_df.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(reference_df, single_pass_df, check_dtype=False)
+
+    print(f"{file_path}: {len(single_pass_df.index)} stations, read_fwf {reference_time:.3f}s, single pass {single_pass_time:.3f}s, speedup {reference_time/single_pass_time:.1f}x")